@@ -0,0 +1,12 @@
+#coding: utf-8
+"""Benchmarks of django-bit-category on synthetic trees.
+
+Run from the repository root::
+
+    python -m benchmarks --depth 4 --fanout 10 --products 1000000 --output results.json
+
+A fresh SQLite database is filled with a tree of given depth and fan-out
+(limited by the capacity of the bit layout) and with products spread over
+its leaves. Every operation is timed and its queries are counted; results
+are written as JSON so runs on different commits can be compared.
+"""
@@ -0,0 +1,125 @@
+#coding: utf-8
+"""Command line entry point: python -m benchmarks --help"""
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    parser.add_argument("--depth", type=int, default=4, help="levels of the tree")
+    parser.add_argument("--fanout", type=int, default=10, help="children of every inner node")
+    parser.add_argument("--products", type=int, default=100000, help="referencing rows")
+    parser.add_argument("--repeat", type=int, default=20, help="calls of every operation")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent writers")
+    parser.add_argument("--db", help="SQLite file (it is recreated)")
+    parser.add_argument("--output", help="write JSON results to a file instead of stdout")
+    return parser.parse_args(argv)
+
+
+def setup_django(db):
+    sys.path[:0] = [ROOT, os.path.join(ROOT, "testapp")]
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmarks.settings"
+    if db:
+        os.environ["BITCATEGORY_BENCH_DB"] = db
+    import django
+    from django.conf import settings
+    if os.path.exists(settings.DATABASES["default"]["NAME"]):
+        os.remove(settings.DATABASES["default"]["NAME"])
+    django.setup()
+    from django.core.management import call_command
+    call_command("migrate", run_syncdb=True, verbosity=0)
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    import django
+    from django.test import RequestFactory
+
+    from bitcategory.models import Category
+    from bitcategory.pagination import SubtreePaginator
+    from bitcategory.views import ajax
+    from bitcategory.widgets import HierarchicalSelect
+    from testapp.models import Product
+
+    from benchmarks.measure import measure, measure_concurrent
+    from benchmarks.trees import capacity, create_products, create_tree
+
+    depth, fanout = capacity(Category, options.depth, options.fanout)
+    leaf_ids = create_tree(Category, depth, fanout)
+    create_products(Product, "category", leaf_ids, options.products)
+    leaf = Category.objects.get(pk=leaf_ids[len(leaf_ids) // 2])
+    root = Category.objects.get(pk=leaf.root_id)
+    repeat = options.repeat
+    names = itertools.count()
+
+    def new_root():
+        return Category.objects.create(name="bench{0}".format(next(names)))
+
+    widget = HierarchicalSelect()
+    widget.model, widget.url = Category, "/hierarchical_ajax"
+    factory = RequestFactory()
+    slots = Category.bit_layout().slot_masks[2]
+    save_parent, concurrent_parent = new_root(), new_root()
+
+    results = [
+        measure("get_free_id", Category(parent=leaf.parent, level=leaf.level).get_free_id, repeat),
+        measure("save", lambda: Category.objects.create(
+            name="s{0}".format(next(names)), parent=save_parent), min(repeat, slots)),
+        measure("ancestors", lambda: list(leaf.ancestors), repeat),
+        measure("descendants", lambda: list(root.descendants), repeat),
+        measure("neighbours", lambda: list(leaf.neighbours), repeat),
+        measure("full_name", leaf.full_name, repeat),
+        measure("products_in_subtree", lambda: Product.objects.filter(
+            category__subtree=root).count(), repeat),
+        measure("products_page", lambda: list(SubtreePaginator(
+            Product.objects.all(), "category", root, 50).page()), repeat),
+        measure("HierarchicalSelect.render", lambda: widget.render(
+            "category", leaf.pk, {"id": "id_category"}), repeat),
+        measure("ajax", lambda: ajax(factory.get("/hierarchical_ajax", {"id": root.pk}),
+                                     model=Category), repeat),
+        measure_concurrent("concurrent_save", lambda thread, call: Category.objects.create(
+            name="c{0}.{1}".format(thread, call), parent=concurrent_parent),
+            threads=options.threads, calls=max(1, slots // options.threads)),
+    ]
+    return {
+        "meta": {
+            "commit": commit(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "depth": depth,
+            "fanout": fanout,
+            "nodes": Category.objects.count(),
+            "products": options.products,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    setup_django(options.db)
+    output = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as fp:
+            fp.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#coding: utf-8
+"""Timing and query counting of benchmarked operations."""
+import threading
+from timeit import default_timer
+
+from django.db import connection, connections
+from django.test.utils import CaptureQueriesContext
+
+
+def measure(name, func, repeat=20, setup=None):
+    """Call `func` `repeat` times and return a result dict.
+
+    :param: `setup` optional callable whose return value is passed to `func`;
+            it is neither timed nor counted
+    """
+    times, queries = [], 0
+    for i in range(repeat):
+        arguments = (setup(), ) if setup else ()
+        with CaptureQueriesContext(connection) as context:
+            start = default_timer()
+            func(*arguments)
+            times.append(default_timer() - start)
+        queries += len(context.captured_queries)
+    times.sort()
+    return {
+        "name": name,
+        "calls": repeat,
+        "queries_per_call": queries / float(repeat),
+        "min": times[0],
+        "median": times[len(times) // 2],
+        "mean": sum(times) / len(times),
+    }
+
+
+def measure_concurrent(name, func, threads=8, calls=3):
+    """Run `func` `calls` times in each of `threads` threads and report calls per second."""
+    errors = []
+
+    def run(thread):
+        try:
+            for call in range(calls):
+                func(thread, call)
+        except Exception as error:
+            errors.append(repr(error))
+        finally:
+            connections.close_all()
+    workers = [threading.Thread(target=run, args=(thread, )) for thread in range(threads)]
+    start = default_timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = default_timer() - start
+    return {
+        "name": name,
+        "calls": threads * calls,
+        "threads": threads,
+        "errors": errors,
+        "per_second": threads * calls / elapsed,
+        "total": elapsed,
+    }
@@ -0,0 +1,30 @@
+#coding: utf-8
+"""Django settings of the benchmarks (the database is given by BITCATEGORY_BENCH_DB)."""
+import os
+import tempfile
+
+DEBUG = False
+SECRET_KEY = "benchmarks"
+USE_TZ = True
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ.get("BITCATEGORY_BENCH_DB",
+                               os.path.join(tempfile.gettempdir(), "bitcategory_bench.db")),
+        "OPTIONS": {"timeout": 30},
+    }
+}
+
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+}
+
+INSTALLED_APPS = (
+    "django.contrib.contenttypes",
+    "bitcategory",
+    "testapp",
+)
+
+MIDDLEWARE_CLASSES = ()
+ROOT_URLCONF = "testapp.urls"
@@ -0,0 +1,35 @@
+#coding: utf-8
+"""Synthetic trees and referencing rows."""
+import random
+
+
+def capacity(model, depth, fanout):
+    """Return (depth, fanout) limited by the bit layout of `model`."""
+    layout = model.bit_layout()
+    depth = min(depth, layout.depth)
+    fanout = min([fanout] + [layout.slot_masks[level] for level in range(1, depth + 1)])
+    return depth, fanout
+
+
+def tree_nodes(depth, fanout, prefix="n"):
+    """Return nodes for `bulk_create_tree` of a full tree with names like n3.1.2."""
+    if depth == 0:
+        return []
+    return [("{0}{1}".format(prefix, i), None, tree_nodes(depth - 1, fanout, "{0}{1}.".format(prefix, i)))
+            for i in range(1, fanout + 1)]
+
+
+def create_tree(model, depth, fanout, batch_size=1000):
+    """Create a full tree and return list of its leaves' IDs."""
+    created = model.objects.bulk_create_tree(tree_nodes(depth, fanout), batch_size=batch_size)
+    return [node.pk for node in created if node.level == depth]
+
+
+def create_products(model, field, leaf_ids, count, batch_size=10000, seed=0):
+    """Create `count` rows of `model` pointing to random leaves by its foreign key `field`."""
+    attname = model._meta.get_field(field).attname
+    rand = random.Random(seed)
+    for start in range(0, count, batch_size):
+        model.objects.bulk_create([
+            model(name="p{0}".format(i), **{attname: rand.choice(leaf_ids)})
+            for i in range(start, min(start + batch_size, count))])
@@ -0,0 +1,135 @@
+#coding: utf-8
+"""Async counterparts of the tree API (Python 3 only).
+
+`HierarchicalModel` gets these methods on Python 3::
+
+    ancestors = await category.aancestors()
+    descendants = await category.adescendants(max_depth=2)
+    root = await category.aroot()
+    pk = await category.aget_free_id()
+    await category.asave()
+
+Supported versions of Django have no async ORM, so every query is run by
+asgiref's `sync_to_async` in a worker thread and the event loop is never
+blocked. asgiref is an optional dependency (the ``async`` extra); without
+it the methods raise `ImproperlyConfigured`.
+"""
+import asyncio
+import functools
+from timeit import default_timer
+
+from django.core.exceptions import ImproperlyConfigured
+
+from bitcategory.instrumentation import count_queries, get_backend
+
+
+class _Counter(object):
+    count = 0
+
+
+def _current_task():
+    current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+    try:
+        return current_task()
+    except RuntimeError:  # no running loop
+        return None
+
+
+def _counted(func, counters):
+    """Wrap `func` to add its queries to `counters` of instrumented coroutines."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with count_queries() as counter:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                for outer in counters:
+                    outer.count += counter.count
+    return wrapper
+
+
+async def run_sync(func, *args, **kwargs):
+    """Run sync `func` in a worker thread (thread sensitive so it shares the connection).
+
+    :raises: `ImproperlyConfigured` when asgiref is missing; running the ORM
+             in the event loop would stall every other coroutine
+    """
+    try:
+        from asgiref.sync import sync_to_async
+    except ImportError:
+        raise ImproperlyConfigured("Async methods of bitcategory need asgiref "
+                                   "(pip install django-bit-category[async])")
+    counters = getattr(_current_task(), "bitcategory_query_counters", None)
+    if counters:
+        func = _counted(func, counters)
+    return await sync_to_async(func, thread_sensitive=True)(*args, **kwargs)
+
+
+async def alist(queryset):
+    """Evaluate `queryset` into a list."""
+    return await run_sync(list, queryset)
+
+
+async def aget(queryset, **kwargs):
+    """Async `queryset.get(**kwargs)`."""
+    return await run_sync(queryset.get, **kwargs)
+
+
+def instrumented(name):
+    """`bitcategory.instrumentation.instrumented` for coroutine functions.
+
+    Queries of all `run_sync` calls awaited by the coroutine are counted.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            backend = get_backend()
+            task = _current_task()
+            if backend is None or task is None:
+                return await func(*args, **kwargs)
+            counter = _Counter()
+            counters = getattr(task, "bitcategory_query_counters", [])
+            task.bitcategory_query_counters = counters + [counter]
+            start = default_timer()
+            try:
+                result = await func(*args, **kwargs)
+            finally:
+                task.bitcategory_query_counters = counters
+            backend.record(name, default_timer() - start, counter.count)
+            return result
+        return wrapper
+    return decorator
+
+
+class AsyncHierarchicalMixin(object):
+    """Async methods of `HierarchicalModel`; they return lists instead of querysets."""
+
+    async def aancestors(self):
+        """List of ancestors including itself ordered from the root."""
+        cached = self.__dict__.get("_ancestors_cache")
+        if cached is not None:
+            return list(cached)
+        return await alist(self.ancestors)
+
+    async def adescendants(self, max_depth=None):
+        """List of descendants including itself in ID (depth-first) order."""
+        return await alist(self._subtree(max_depth).order_by("id"))
+
+    async def aroot(self):
+        """Root node (itself or a prefetched one without a query)."""
+        if self.root_id == self.id:
+            return self
+        if "_ancestors_cache" in self.__dict__:
+            return self._ancestors_cache[0]
+        return await aget(self.__class__.objects, pk=self.root_id)
+
+    async def aget_free_id(self):
+        return (await self.aget_free_ids(1))[0]
+
+    async def aget_free_ids(self, count):
+        """Async `get_free_ids`."""
+        return await run_sync(self.get_free_ids, count)
+
+    async def asave(self, *args, **kwargs):
+        """Async `save`."""
+        return await run_sync(self.save, *args, **kwargs)
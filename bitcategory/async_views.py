@@ -0,0 +1,45 @@
+#coding: utf-8
+"""Async variant of `bitcategory.views.ajax` for ASGI deployments (Python 3 only).
+
+It answers the same requests with the same JSON and conditional headers::
+
+    from bitcategory import async_views
+
+    urlpatterns = [
+        path("hierarchical_ajax", async_views.ajax, {"model": MyCategory}, name="hierarchical_ajax"),
+    ]
+"""
+from calendar import timegm
+
+import django
+from django.http import HttpResponseBadRequest
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from bitcategory.aio import alist, instrumented, run_sync
+from bitcategory.views import (
+    AJAX_BAD_REQUEST, _ajax_query, _ajax_response, tree_etag, tree_last_modified)
+
+
+@instrumented("async_views.ajax")
+async def ajax(request, model):
+    '''Async `bitcategory.views.ajax`; the version and the rows are fetched in a worker thread.'''
+    # the version may come from a cache backend doing network I/O
+    etag = await run_sync(tree_etag, request, model)
+    last_modified = timegm((await run_sync(tree_last_modified, request, model)).utctimetuple())
+    # Django < 1.11 quotes the ETag itself
+    response = get_conditional_response(
+        request, etag=quote_etag(etag) if django.VERSION >= (1, 11) else etag,
+        last_modified=last_modified)
+    if response is None:
+        try:
+            pks, depth, rows = _ajax_query(request, model)
+        except (ValueError, KeyError):
+            response = HttpResponseBadRequest(AJAX_BAD_REQUEST)
+        else:
+            response = _ajax_response(request, model, pks, depth, await alist(rows))
+    if not response.has_header("Last-Modified"):
+        response["Last-Modified"] = http_date(last_modified)
+    if not response.has_header("ETag"):
+        response["ETag"] = quote_etag(etag)
+    return response
@@ -0,0 +1,28 @@
+#coding: utf-8
+"""Helpers hiding differences of Django versions."""
+
+
+def get_cached_related(instance, field):
+    """Return related object of foreign key `field` cached on `instance` (or None)."""
+    if hasattr(field, "get_cached_value"):
+        return field.get_cached_value(instance, None)  # Django >= 2.0
+    return getattr(instance, field.get_cache_name(), None)
+
+
+def set_cached_related(instance, field, value):
+    """Put `value` into the cache of foreign key `field` of `instance`."""
+    if hasattr(field, "set_cached_value"):
+        field.set_cached_value(instance, value)  # Django >= 2.0
+    else:
+        setattr(instance, field.get_cache_name(), value)
+
+
+def remote_field(field):
+    """Return relation object of the foreign key `field` (`remote_field` or `rel`)."""
+    remote = getattr(field, "remote_field", None)
+    return remote if remote is not None else field.rel
+
+
+def remote_model(field):
+    """Return model the foreign key `field` points to."""
+    return remote_field(field).model
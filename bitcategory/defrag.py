@@ -0,0 +1,157 @@
+#coding: utf-8
+"""Slot occupancy report and offline compaction of IDs.
+
+Deleted nodes leave gaps among their siblings and busy parents slowly run
+out of slots of their level. `capacity_report` tells how many slots every
+parent uses and how many are left; `compact` renumbers siblings to take
+slots 1, 2, ... in their `ordering` (then ID) order::
+
+    report = capacity_report(MyCategory)
+    mapping, steps = compact(MyCategory, dry_run=True)  # nothing is written
+
+The whole old -> new mapping is computed in memory and written by batched
+CASE UPDATEs in one transaction: first to negative (temporary) IDs so no
+statement collides with an ID still in use, then flipped to the final ones.
+Foreign keys registered in `bitcategory.references` are remapped the same
+way. Other foreign keys to the tree would keep dangling IDs, so `compact`
+refuses to run while there are any (see
+`bitcategory.references.check_registered`) unless told to ignore them. Compaction is meant to be run offline, without
+concurrent writers.
+"""
+from django.db import models, router, transaction
+from django.db.models import Case, F, Value, When
+
+from bitcategory import references
+
+
+def capacity_report(model):
+    """Return slot occupancy of the tree of `model` by two grouped queries.
+
+    :rvalue: {"levels": [...], "parents": [...]} where every parent (None for
+        the roots) having children has a dict with keys parent_id, level (of
+        the children), used, capacity, free, last_slot and gaps (free slots
+        below the last used one) and every level has level, nodes, parents,
+        capacity (slots of one parent), max_used and min_free
+    """
+    layout = model.bit_layout()
+    rows = model._base_manager.using(router.db_for_read(model))
+    parents = []
+    for row in rows.order_by().values("parent_id").annotate(
+            used=models.Count("id"), last=models.Max("id")):
+        level = layout.level_of(row["last"])
+        last_slot = layout.slot(row["last"], level)
+        capacity = layout.slot_masks[level]
+        parents.append({
+            "parent_id": row["parent_id"],
+            "level": level,
+            "used": row["used"],
+            "capacity": capacity,
+            "free": capacity - row["used"],
+            "last_slot": last_slot,
+            "gaps": last_slot - row["used"],
+        })
+    parents.sort(key=lambda parent: (parent["level"], parent["parent_id"] or 0))
+    levels = []
+    for row in rows.order_by().values("level").annotate(nodes=models.Count("id")).order_by("level"):
+        used = [parent["used"] for parent in parents if parent["level"] == row["level"]]
+        capacity = layout.slot_masks[row["level"]]
+        levels.append({
+            "level": row["level"],
+            "nodes": row["nodes"],
+            "parents": len(used),
+            "capacity": capacity,
+            "max_used": max(used),
+            "min_free": capacity - max(used),
+        })
+    return {"levels": levels, "parents": parents}
+
+
+def compaction_mapping(model):
+    """Return {old ID: new ID} of all nodes with siblings packed into the lowest slots.
+
+    Siblings keep their `ordering` (ties broken by the old ID) and
+    descendants follow their ancestors. The table is loaded by one query
+    from the database written to, so a lagging replica cannot give a stale
+    mapping.
+    """
+    layout = model.bit_layout()
+    rows = model._base_manager.using(router.db_for_write(model))
+    children = {}
+    for pk, parent_id, level, ordering in rows.order_by("id").values_list(
+            "id", "parent_id", "level", "ordering").iterator():
+        children.setdefault(parent_id, []).append((ordering, pk, level))
+    mapping = {}
+    stack = [(None, 0)]
+    while stack:
+        parent_id, new_parent_id = stack.pop()
+        for slot, (ordering, pk, level) in enumerate(sorted(children.get(parent_id, ())), 1):
+            mapping[pk] = new_parent_id + (slot << layout.right_offsets[level])
+            stack.append((pk, mapping[pk]))
+    return mapping
+
+
+def _batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def _remap_column(rows, attname, mapping, changed, batch_size):
+    """Move `attname` of `rows` from old to negated new IDs, then flip the sign.
+
+    Every statement reads and writes only `attname`, so the order in which
+    the database evaluates assignments does not matter.
+    """
+    count = 0
+    for batch in _batches(changed, batch_size):
+        count += rows.filter(**{attname + "__in": batch}).update(**{attname: Case(
+            *[When(**{attname: pk, "then": Value(-mapping[pk])}) for pk in batch],
+            output_field=models.BigIntegerField())})
+    rows.filter(**{attname + "__lt": 0}).update(**{attname: F(attname) * -1})
+    return count
+
+
+def remap_ids(model, mapping, batch_size=500, dry_run=False):
+    """Apply {old ID: new ID} `mapping` to the tree and registered foreign keys.
+
+    Everything runs in one transaction. With `dry_run` nothing is written
+    and the row counts are only counted.
+
+    :rvalue: list of (step, number of rows) like ("app.Category.id", 42)
+    """
+    model = model._meta.concrete_model
+    using = router.db_for_write(model)
+    changed = sorted(pk for pk, new_id in mapping.items() if pk != new_id)
+    targets = [(model, "id")] + references.references_to(model)
+    steps = []
+    with transaction.atomic(using=using):
+        for target, attname in targets:
+            rows = target._base_manager.using(using)
+            if dry_run:
+                count = sum(rows.filter(**{attname + "__in": batch}).count()
+                            for batch in _batches(changed, batch_size))
+            else:
+                if target is model:
+                    # parents by their own statements; keying them on `id` rewritten by the
+                    # same statement would break on MySQL which assigns left to right
+                    _remap_column(rows, "parent_id", mapping, changed, batch_size)
+                count = _remap_column(rows, attname, mapping, changed, batch_size)
+            steps.append(("{0}.{1}".format(target._meta.label, attname), count))
+    if changed and not dry_run:
+        model.bump_tree_version(using)
+    return steps
+
+
+def compact(model, batch_size=500, dry_run=False, ignore_unregistered=False):
+    """Renumber siblings of the whole tree into the lowest slots.
+
+    :param: `ignore_unregistered` compact even when there are foreign keys to
+            the tree not registered in `bitcategory.references` (their rows
+            keep the old IDs)
+    :raises: `ValueError` when there are unregistered foreign keys
+    :rvalue: (mapping {old ID: new ID}, steps of `remap_ids`)
+    """
+    if not (dry_run or ignore_unregistered):
+        references.check_registered(model)
+    with transaction.atomic(using=router.db_for_write(model)):
+        mapping = compaction_mapping(model)
+        return mapping, remap_ids(model, mapping, batch_size, dry_run)
@@ -1,9 +1,49 @@
 #coding: utf-8
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse_lazy
+from django.db import models
 from django.forms.models import ModelChoiceField
+from bitcategory.lookups import TREE_LOOKUPS, coalesce_ranges
 from bitcategory.widgets import HierarchicalSelect
 
 
+class HierarchicalIdField(models.IntegerField):
+    '''
+    Primary key of a HierarchicalModel. It is stored as BigIntegerField when
+    the model's bit layout has 32 or more bits, because a signed 32 bit column
+    holds only IDs below 2**31 (foreign keys follow).
+    '''
+    def __init__(self, *args, **kwargs):
+        self.big = kwargs.pop("big", False)
+        super(HierarchicalIdField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        # historical models (migrations) have no layout, they keep `big` as it is
+        if not cls._meta.abstract and hasattr(cls, "bit_layout"):
+            self.big = cls.bit_layout().id_bits > 31
+        super(HierarchicalIdField, self).contribute_to_class(cls, name, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(HierarchicalIdField, self).deconstruct()
+        if self.big:
+            kwargs["big"] = True
+        return name, path, args, kwargs
+
+    def get_internal_type(self):
+        return "BigIntegerField" if self.big else "IntegerField"
+
+
+class HierarchicalForeignKey(models.ForeignKey):
+    '''
+    ForeignKey to a HierarchicalModel which understands tree lookups
+    `subtree`, `subtree_in` and `ancestor_of` (see `bitcategory.lookups`).
+    '''
+    def get_lookup(self, lookup_name):
+        if lookup_name in TREE_LOOKUPS:
+            return TREE_LOOKUPS[lookup_name]
+        return super(HierarchicalForeignKey, self).get_lookup(lookup_name)
+
+
 class HierarchicalField(ModelChoiceField):
     '''
     Field which can handles hierarchical structure using multiple
@@ -11,14 +51,23 @@ class HierarchicalField(ModelChoiceField):
     so don't forget to include that into form.media when constructing form.
     '''
     def __init__(self, queryset, label=None, initial=None, namespace=None,
-                 *args, **kwargs):
+                 subtree=None, lazy=False, use_snapshot=False, *args, **kwargs):
         '''
         Ignore queryset - we have to take all options into account.
         The selects are generated via javascript, otherwise it bounds the validation.
 
+        Submitted IDs are checked structurally (bit layout) before touching the DB.
+
         :param: `namespace` is an URL namespace for current Model
+        :param: `subtree` node (or list of nodes) the value has to be within
+        :param: `lazy` only confirm existence of the value and return an instance
+                with deferred fields instead of fetching the whole row
+        :param: `use_snapshot` confirm existence against `tree_snapshot()` (lazy mode)
         '''
         queryset = queryset.model.objects.all()
+        self.subtree = subtree
+        self.lazy = lazy
+        self.use_snapshot = use_snapshot
         super(HierarchicalField, self).__init__(
             widget=HierarchicalSelect, queryset=queryset, initial=initial,
             label=label, *args, **kwargs)
@@ -28,3 +77,32 @@ class HierarchicalField(ModelChoiceField):
             self.widget.url = reverse_lazy("{0}:hierarchical_ajax".format(namespace))
         else:
             self.widget.url = reverse_lazy("hierarchical_ajax")
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        model = self.queryset.model
+        try:
+            pk = int(getattr(value, "pk", value))
+        except (TypeError, ValueError):
+            pk = None
+        if pk is None or not model.is_valid_id(pk) or not self.in_subtree(pk):
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        if not self.lazy:
+            return super(HierarchicalField, self).to_python(pk)
+        if self.use_snapshot:
+            exists = pk in model.tree_snapshot()
+        else:
+            exists = self.queryset.filter(pk=pk).exists()
+        if not exists:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return model.lazy_instance(pk, using=self.queryset.db)
+
+    def in_subtree(self, pk):
+        '''Test whether `pk` is within allowed `subtree` (if any).'''
+        if self.subtree is None:
+            return True
+        nodes = self.subtree if isinstance(self.subtree, (list, tuple)) else [self.subtree]
+        model = self.queryset.model
+        ranges = coalesce_ranges(model.bounds_for(getattr(node, "pk", node)) for node in nodes)
+        return any(gte <= pk < lt for gte, lt in ranges)
@@ -0,0 +1,241 @@
+#coding: utf-8
+"""Call counts, wall time and query counts of tree operations.
+
+Instrumentation is off unless ``BITCATEGORY_STATS_BACKEND`` names a backend
+class; then every instrumented operation reports to it::
+
+    BITCATEGORY_STATS_BACKEND = "bitcategory.instrumentation.CacheBackend"
+
+Backends:
+
+- `NullBackend` records nothing
+- `LoggingBackend` logs every call to the "bitcategory.stats" logger
+- `MemoryBackend` aggregates in memory of the process
+- `CacheBackend` aggregates in the cache (``BITCATEGORY_CACHE``) shared by all
+  processes, so ``manage.py bitcategory_stats`` can dump the numbers
+
+Queries of the default database are counted by an execute wrapper (Django
+>= 2.0) or by wrapping its cursors, so they are counted without ``DEBUG``
+and the SQL is not kept. Properties returning querysets only build them,
+their queries are run by the caller so none are recorded (None).
+"""
+import functools
+import logging
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.utils import CursorWrapper
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger("bitcategory.stats")
+
+_UNSET = object()
+_backend = _UNSET
+
+
+class NullBackend(object):
+    """Backend which records nothing."""
+
+    def record(self, name, seconds, queries):
+        """Record one call of `name` (`queries` is None when they are not counted)."""
+
+    def stats(self):
+        """Return {name: {"calls": int, "time": seconds, "queries": int or None}}."""
+        return {}
+
+    def reset(self):
+        pass
+
+
+class LoggingBackend(NullBackend):
+    """Log every call at DEBUG level."""
+
+    def record(self, name, seconds, queries):
+        logger.debug("%s took %.6fs and %s queries", name, seconds, queries)
+
+
+class MemoryBackend(NullBackend):
+    """Aggregate numbers in the memory of the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def record(self, name, seconds, queries):
+        with self.lock:
+            stats = self.data.setdefault(name, {"calls": 0, "time": 0.0, "queries": None})
+            stats["calls"] += 1
+            stats["time"] += seconds
+            if queries is not None:
+                stats["queries"] = (stats["queries"] or 0) + queries
+
+    def stats(self):
+        with self.lock:
+            return dict((name, dict(stats)) for name, stats in self.data.items())
+
+    def reset(self):
+        with self.lock:
+            self.data = {}
+
+
+class CacheBackend(NullBackend):
+    """Aggregate numbers in the cache shared by all processes (time in microseconds)."""
+    prefix = "bitcategory:stats:"
+
+    def __init__(self):
+        from bitcategory.models import get_cache
+        self.cache = get_cache()
+
+    def _register(self, name):
+        """Give a new `name` the next numbered slot; `cache.add` lets only one process do it."""
+        if self.cache.add("{0}name:{1}".format(self.prefix, name), True, None):
+            self.cache.add(self.prefix + "names", 0, None)
+            index = self.cache.incr(self.prefix + "names")
+            self.cache.set("{0}names:{1}".format(self.prefix, index), name, None)
+
+    def _names(self):
+        keys = ["{0}names:{1}".format(self.prefix, index)
+                for index in range(1, self.cache.get(self.prefix + "names", 0) + 1)]
+        return [name for name in self.cache.get_many(keys).values() if name is not None]
+
+    def record(self, name, seconds, queries):
+        self._register(name)
+        for key, value in (("calls", 1), ("time", int(seconds * 1e6)), ("queries", queries)):
+            if value is None:
+                continue
+            key = "{0}{1}:{2}".format(self.prefix, name, key)
+            if not self.cache.add(key, value, None):
+                try:
+                    self.cache.incr(key, value)
+                except ValueError:  # evicted meanwhile
+                    self.cache.set(key, value, None)
+
+    def stats(self):
+        result = {}
+        for name in self._names():
+            keys = dict((key, "{0}{1}:{2}".format(self.prefix, name, key))
+                        for key in ("calls", "time", "queries"))
+            values = self.cache.get_many(keys.values())
+            stats = dict((key, values.get(cache_key, 0)) for key, cache_key in keys.items())
+            stats["queries"] = values.get(keys["queries"])
+            stats["time"] /= 1e6
+            result[name] = stats
+        return result
+
+    def reset(self):
+        count = self.cache.get(self.prefix + "names", 0)
+        names = self._names()
+        self.cache.delete_many(
+            ["{0}{1}:{2}".format(self.prefix, name, key)
+             for name in names for key in ("calls", "time", "queries")] +
+            ["{0}name:{1}".format(self.prefix, name) for name in names] +
+            ["{0}names:{1}".format(self.prefix, index) for index in range(1, count + 1)] +
+            [self.prefix + "names"])
+
+
+def get_backend():
+    """Return the configured backend or None when instrumentation is off."""
+    global _backend
+    if _backend is _UNSET:
+        path = getattr(settings, "BITCATEGORY_STATS_BACKEND", None)
+        _backend = import_string(path)() if path else None
+    return _backend
+
+
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting == "BITCATEGORY_STATS_BACKEND":
+        _backend = _UNSET
+
+
+setting_changed.connect(_reset_backend)
+
+
+class _QueryCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class _CountingCursorWrapper(CursorWrapper):
+    """Cursor wrapper counting executed statements into active counters of its connection."""
+
+    def _count(self):
+        for counter in self.db.bitcategory_query_counters:
+            counter.count += 1
+
+    def callproc(self, *args, **kwargs):
+        self._count()
+        return super(_CountingCursorWrapper, self).callproc(*args, **kwargs)
+
+    def execute(self, *args, **kwargs):
+        self._count()
+        return super(_CountingCursorWrapper, self).execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._count()
+        return super(_CountingCursorWrapper, self).executemany(*args, **kwargs)
+
+
+def _counting(make_cursor, db):
+    def wrapper(cursor):
+        return _CountingCursorWrapper(make_cursor(cursor), db)
+    return wrapper
+
+
+@contextmanager
+def count_queries(using=DEFAULT_DB_ALIAS):
+    """Count statements executed on the database `using` within the block.
+
+    Yields a counter whose `count` is updated as the statements run.
+    """
+    db = connections[using]
+    counter = _QueryCounter()
+    if hasattr(db, "execute_wrapper"):
+        with db.execute_wrapper(counter):
+            yield counter
+        return
+    if getattr(db, "bitcategory_query_counters", None) is None:
+        # the connection object belongs to one thread, wrap its cursors once
+        db.bitcategory_query_counters = []
+        db.make_cursor = _counting(db.make_cursor, db)
+        db.make_debug_cursor = _counting(db.make_debug_cursor, db)
+    db.bitcategory_query_counters.append(counter)
+    try:
+        yield counter
+    finally:
+        db.bitcategory_query_counters.remove(counter)
+
+
+def instrumented(name, queries=True):
+    """Decorator reporting calls of the function as operation `name`.
+
+    :param: `queries` False for functions which only build lazy querysets (their
+            queries run later in the caller so the count is recorded as None)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            backend = _backend if _backend is not _UNSET else get_backend()
+            if backend is None:
+                return func(*args, **kwargs)
+            if not queries:
+                start = default_timer()
+                result = func(*args, **kwargs)
+                backend.record(name, default_timer() - start, None)
+                return result
+            with count_queries() as counter:
+                start = default_timer()
+                result = func(*args, **kwargs)
+            backend.record(name, default_timer() - start, counter.count)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,124 @@
+#coding: utf-8
+"""Bit layout of hierarchical IDs.
+
+Every level of the tree owns a block of bits of the ID, starting from the
+most significant bits for the roots. The blocks may have different widths
+so the levels with many items can get more bits::
+
+    class MyCategory(CategoryBase):
+        # 64 roots, 1023 children on the second and third level ...
+        LAYOUT = BitLayout([6, 10, 10, 8, 8, 8, 8], id_bits=63)
+
+Per-level values are precomputed into tuples indexed by level (index 0 is
+the empty prefix above the roots), so no arithmetic besides shifts and masks
+is needed at runtime.
+"""
+
+
+class BitLayout(object):
+    """
+    Widths of levels of an ID with `id_bits` bits.
+
+    :param: `widths` bit widths of levels 1, 2, ... (the level can take
+            2^width - 1 items because slot 0 is never used)
+    :param: `id_bits` number of bits of the ID; up to 31 fits into (signed)
+            IntegerField, more makes `HierarchicalModel.id` a BigIntegerField.
+            The sign bit is never used so the maximum is 63.
+    """
+    def __init__(self, widths, id_bits=32):
+        widths = tuple(widths)
+        if not widths or min(widths) < 1:
+            raise ValueError("Every level has to have at least one bit")
+        if sum(widths) > id_bits:
+            raise ValueError("Levels {0} do not fit into {1} bits".format(widths, id_bits))
+        if id_bits > 63:
+            raise ValueError("IDs can have at most 63 bits (the sign bit is not used)")
+        self.id_bits = id_bits
+        self.depth = len(widths)
+        self.widths = (0, ) + widths
+        left = 0
+        left_offsets = [0]
+        for width in widths:
+            left += width
+            left_offsets.append(left)
+        self.left_offsets = tuple(left_offsets)
+        self.right_offsets = tuple(id_bits - left for left in left_offsets)
+        self.steps = tuple(1 << right for right in self.right_offsets)
+        self.masks = tuple(((1 << left) - 1) << right
+                           for left, right in zip(self.left_offsets, self.right_offsets))
+        self.slot_masks = tuple((1 << width) - 1 for width in self.widths)
+        # level of a node whose lowest set bit is the index (depth + 1 is invalid)
+        self.bit_levels = tuple(
+            min([level for level in range(1, self.depth + 1) if self.right_offsets[level] <= bit] or
+                [self.depth + 1])
+            for bit in range(id_bits))
+
+    @classmethod
+    def uniform(cls, level_bits, id_bits=32):
+        """Layout with as many levels of `level_bits` as fit into `id_bits`."""
+        return cls([level_bits] * (id_bits // level_bits), id_bits)
+
+    def __eq__(self, other):
+        return isinstance(other, BitLayout) and \
+            (self.widths, self.id_bits) == (other.widths, other.id_bits)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.widths, self.id_bits))
+
+    def __repr__(self):
+        return "BitLayout({0}, id_bits={1})".format(list(self.widths[1:]), self.id_bits)
+
+    def left_offset(self, level):
+        """Number of bits used by levels 1..level (from left)."""
+        if level > self.depth:
+            return self.id_bits + level - self.depth
+        return self.left_offsets[level]
+
+    def right_offset(self, level):
+        """Number of bits right of the `level` block (negative for too deep level)."""
+        if level > self.depth:
+            return self.depth - level
+        return self.right_offsets[level]
+
+    def level_of(self, pk):
+        """Level of the node with ID `pk` (depth + 1 for malformed IDs)."""
+        if pk <= 0:
+            raise ValueError("Hierarchical ID has to be positive, got {0}".format(pk))
+        return self.bit_levels[min((pk & -pk).bit_length(), self.id_bits) - 1]
+
+    def bounds(self, pk):
+        """(gte, lt) bounds of descendant IDs of the node with ID `pk`."""
+        level = self.level_of(pk)
+        if level > self.depth:
+            raise ValueError("Malformed hierarchical ID {0}".format(pk))
+        return pk, pk + self.steps[level]
+
+    def ancestors(self, pk):
+        """IDs of all ancestors of `pk` including itself ordered from the root."""
+        level = self.level_of(pk)
+        if level > self.depth:
+            raise ValueError("Malformed hierarchical ID {0}".format(pk))
+        return [pk & self.masks[ancestor] for ancestor in range(1, level + 1)]
+
+    def parent(self, pk):
+        """ID of the parent of `pk` (None for roots)."""
+        level = self.level_of(pk)
+        if level > self.depth:
+            raise ValueError("Malformed hierarchical ID {0}".format(pk))
+        return (pk & self.masks[level - 1]) or None
+
+    def slot(self, pk, level):
+        """Number of the slot `pk` takes in `level`."""
+        return (pk >> self.right_offsets[level]) & self.slot_masks[level]
+
+    def is_valid(self, pk):
+        """Test whether `pk` is a well formed ID of a node."""
+        if pk <= 0 or pk >> self.id_bits:
+            return False
+        level = self.level_of(pk)
+        if level > self.depth:
+            return False
+        return all(self.slot(pk, ancestor) for ancestor in range(1, level))
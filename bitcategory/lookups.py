@@ -0,0 +1,103 @@
+#coding: utf-8
+"""Tree lookups for foreign keys to hierarchical models.
+
+They are available on `bitcategory.fields.HierarchicalForeignKey`::
+
+    MyProduct.objects.filter(category__subtree=category)
+    MyProduct.objects.filter(category__subtree_in=[category1, category2])
+    MyProduct.objects.filter(category__ancestor_of=category)
+
+Values can be model instances or IDs. Subtrees are compiled into plain range
+conditions (``category_id >= %s AND category_id < %s``) which can use an
+index. Overlapping and adjacent subtrees are merged first, so selecting a
+category together with its subcategories costs just one range.
+"""
+import six
+
+from django.db.models import Lookup, Q
+
+from bitcategory.compat import remote_model
+
+
+def coalesce_ranges(ranges):
+    """Merge nested, overlapping and adjacent [gte, lt) ranges.
+
+    :rvalue: sorted list of disjoint (gte, lt) tuples
+    """
+    merged = []
+    for gte, lt in sorted(ranges):
+        if merged and gte <= merged[-1][1]:
+            if lt > merged[-1][1]:
+                merged[-1] = (merged[-1][0], lt)
+        else:
+            merged.append((gte, lt))
+    return merged
+
+
+def ranges_q(name, ranges):
+    """Return Q object selecting `name` in any of [gte, lt) `ranges`."""
+    query = Q()
+    for gte, lt in ranges:
+        query |= Q(**{name + "__gte": gte, name + "__lt": lt})
+    return query
+
+
+def _nodes(value):
+    if isinstance(value, six.integer_types) or hasattr(value, "_meta"):
+        return [value]
+    return list(value)
+
+
+def _pk(node):
+    return node if isinstance(node, six.integer_types) else node.pk
+
+
+class TreeLookup(Lookup):
+    """Base for lookups whose right side are hierarchical nodes."""
+
+    @property
+    def tree_model(self):
+        return remote_model(self.lhs.output_field)
+
+    def get_prep_lookup(self):
+        return [_pk(node) for node in _nodes(self.rhs)]
+
+
+class SubtreeLookup(TreeLookup):
+    """Rows pointing to any of the given nodes or their descendants."""
+    lookup_name = "subtree"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        ranges = coalesce_ranges(self.tree_model.bounds_for(pk) for pk in self.rhs)
+        if not ranges:
+            return "1 = 0", []
+        condition = "({0} >= %s AND {0} < %s)".format(lhs)
+        params = []
+        for gte, lt in ranges:
+            params.extend(lhs_params + [gte] + lhs_params + [lt])
+        if len(ranges) == 1:
+            return condition, params
+        return "({0})".format(" OR ".join([condition] * len(ranges))), params
+
+
+class SubtreeInLookup(SubtreeLookup):
+    lookup_name = "subtree_in"
+
+
+class AncestorOfLookup(TreeLookup):
+    """Rows pointing to any ancestor (including itself) of the given nodes."""
+    lookup_name = "ancestor_of"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        ids = set()
+        for pk in self.rhs:
+            ids.update(self.tree_model.ancestor_ids_for(pk))
+        if not ids:
+            return "1 = 0", []
+        return "{0} IN ({1})".format(lhs, ", ".join(["%s"] * len(ids))), lhs_params + sorted(ids)
+
+
+TREE_LOOKUPS = dict((lookup.lookup_name, lookup) for lookup in (
+    SubtreeLookup, SubtreeInLookup, AncestorOfLookup))
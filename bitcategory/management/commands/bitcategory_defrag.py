@@ -0,0 +1,76 @@
+#coding: utf-8
+import json
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from bitcategory.defrag import capacity_report, compact
+from bitcategory.models import HierarchicalModel
+from bitcategory.references import unregistered_references
+
+
+class Command(BaseCommand):
+    help = "Report slot occupancy of a hierarchical model and optionally compact its IDs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="Hierarchical model as app_label.ModelName.")
+        parser.add_argument("--threshold", type=int, default=2,
+                            help="List parents with at most this many free slots (default 2).")
+        parser.add_argument("--json", action="store_true", dest="json", default=False,
+                            help="Output the whole report as JSON.")
+        parser.add_argument("--compact", action="store_true", dest="compact", default=False,
+                            help="Renumber siblings into the lowest slots (run it offline).")
+        parser.add_argument("--dry-run", action="store_true", dest="dry_run", default=False,
+                            help="With --compact only count rows every step would update.")
+        parser.add_argument("--ignore-unregistered", action="store_true",
+                            dest="ignore_unregistered", default=False,
+                            help="Compact even though foreign keys not registered in "
+                                 "bitcategory.references would keep old IDs.")
+        parser.add_argument("--batch-size", type=int, default=500, dest="batch_size",
+                            help="IDs remapped by one UPDATE (default 500).")
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not issubclass(model, HierarchicalModel):
+            raise CommandError("{0} is not a hierarchical model".format(options["model"]))
+        report = capacity_report(model)
+        if options["compact"]:
+            try:
+                mapping, steps = compact(model, options["batch_size"], options["dry_run"],
+                                         ignore_unregistered=options["ignore_unregistered"])
+            except ValueError as e:
+                raise CommandError("{0}. Register them or pass --ignore-unregistered.".format(e))
+            for ref_model, attname in unregistered_references(model):
+                self.stderr.write("Warning: {0}.{1} is not registered in bitcategory.references "
+                                  "and is not remapped".format(ref_model._meta.label, attname))
+            report["compaction"] = {
+                "dry_run": options["dry_run"],
+                "moved": sum(1 for pk, new_id in mapping.items() if pk != new_id),
+                "steps": [{"step": step, "rows": rows} for step, rows in steps],
+            }
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            return
+        self.stdout.write("{0:>5} {1:>8} {2:>8} {3:>9} {4:>9} {5:>9}".format(
+            "level", "nodes", "parents", "capacity", "max used", "min free"))
+        for row in report["levels"]:
+            self.stdout.write("{level:>5} {nodes:>8} {parents:>8} {capacity:>9} "
+                              "{max_used:>9} {min_free:>9}".format(**row))
+        crowded = [row for row in report["parents"] if row["free"] <= options["threshold"]]
+        if crowded:
+            self.stdout.write("\nParents with at most {0} free slots:".format(options["threshold"]))
+            self.stdout.write("{0:>20} {1:>5} {2:>6} {3:>9} {4:>6} {5:>9} {6:>6}".format(
+                "parent", "level", "used", "capacity", "free", "last slot", "gaps"))
+            for row in crowded:
+                self.stdout.write("{0:>20} {level:>5} {used:>6} {capacity:>9} {free:>6} "
+                                  "{last_slot:>9} {gaps:>6}".format(
+                                      "-" if row["parent_id"] is None else row["parent_id"], **row))
+        if "compaction" in report:
+            compaction = report["compaction"]
+            self.stdout.write("\n{0} {1} nodes".format(
+                "Would move" if compaction["dry_run"] else "Moved", compaction["moved"]))
+            for step in compaction["steps"]:
+                self.stdout.write("{0:<40} {1:>9} rows".format(step["step"], step["rows"]))
@@ -0,0 +1,36 @@
+#coding: utf-8
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bitcategory.instrumentation import get_backend
+
+
+class Command(BaseCommand):
+    help = "Dump numbers collected by BITCATEGORY_STATS_BACKEND."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", action="store_true", dest="json", default=False,
+                            help="Output JSON instead of a table.")
+        parser.add_argument("--reset", action="store_true", dest="reset", default=False,
+                            help="Clear the numbers after dumping them.")
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        if backend is None:
+            raise CommandError("Instrumentation is off, set BITCATEGORY_STATS_BACKEND")
+        stats = backend.stats()
+        if options["json"]:
+            self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
+        else:
+            self.stdout.write("{0:<36} {1:>8} {2:>10} {3:>10} {4:>8} {5:>8}".format(
+                "operation", "calls", "time [s]", "avg [ms]", "queries", "q/call"))
+            for name, row in sorted(stats.items(), key=lambda item: -item[1]["time"]):
+                calls = row["calls"] or 1
+                queries, per_call = "-", "-"  # not counted for lazy querysets
+                if row["queries"] is not None:
+                    queries, per_call = row["queries"], "{0:.2f}".format(row["queries"] / float(calls))
+                self.stdout.write("{0:<36} {1:>8} {2:>10.3f} {3:>10.3f} {4:>8} {5:>8}".format(
+                    name, row["calls"], row["time"], row["time"] * 1000 / calls, queries, per_call))
+        if options["reset"]:
+            backend.reset()
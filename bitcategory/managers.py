@@ -0,0 +1,282 @@
+#coding: utf-8
+import six
+
+from django.db import models, router, transaction
+from django.db.models.deletion import ProtectedError, get_candidate_relations_to_delete
+
+from bitcategory import references
+from bitcategory.compat import get_cached_related, remote_field, remote_model, set_cached_related
+from bitcategory.lookups import coalesce_ranges, ranges_q
+from bitcategory.signals import subtree_deleted
+
+
+def prefetch_ancestors(instances, *fields):
+    """Load ancestors of hierarchical nodes of all `instances` by one query per model.
+
+    Every node gets an ordered list of its ancestors (from the root, ending
+    with the node itself) so `ancestors`, `root` and `full_name()` do not
+    query the database. Union of ancestor IDs is computed from the bits.
+
+    :param: `instances` list of hierarchical nodes or of models referencing them
+    :param: `fields` names of foreign keys to hierarchical models (related
+            lookups with "__" are followed by attribute access). Without fields
+            the instances are the nodes themselves. Related nodes are put into
+            the foreign key cache, so they do not cost a query either.
+    """
+    nodes = []  # (model, pk, holder, field) where holder is None for the node itself
+    for instance in instances:
+        for field_path in fields or (None, ):
+            holder, field = instance, None
+            if field_path is not None:
+                path = field_path.split("__")
+                for name in path[:-1]:
+                    holder = getattr(holder, name, None)
+                    if holder is None:
+                        break
+                if holder is None:
+                    continue
+                field = holder._meta.get_field(path[-1])
+                pk = getattr(holder, field.attname)
+                model = remote_model(field)
+            else:
+                pk, model = instance.pk, instance.__class__
+            if pk is not None:
+                nodes.append((model, pk, holder, field))
+
+    loaded = {}
+    for model in set(model for model, pk, holder, field in nodes):
+        ids = set()
+        for node_model, pk, holder, field in nodes:
+            if node_model is model:
+                ids.update(model.ancestor_ids_for(pk))
+        loaded[model] = dict((node.pk, node) for node in
+                             model._default_manager.filter(id__in=ids).order_by("id"))
+    for model, pk, holder, field in nodes:
+        by_id = loaded[model]
+        node = holder if field is None else get_cached_related(holder, field)
+        if node is None:
+            node = by_id.get(pk)
+            if node is None:
+                continue
+            set_cached_related(holder, field, node)
+        chain = [by_id[ancestor_id] for ancestor_id in model.ancestor_ids_for(pk)
+                 if ancestor_id in by_id]
+        for depth, ancestor in enumerate(chain[:-1], 1):
+            ancestor._ancestors_cache = chain[:depth]
+        node._ancestors_cache = chain[:-1] + [node]
+    return instances
+
+
+class PrefetchAncestorsQuerySet(models.QuerySet):
+    """QuerySet which can load ancestors of (related) hierarchical nodes at once.
+
+    Use it as a manager of models referencing hierarchical models::
+
+        class MyProduct(models.Model):
+            category = models.ForeignKey(MyCategory)
+            objects = PrefetchAncestorsManager()
+
+        MyProduct.objects.prefetch_ancestors("category")
+    """
+    def __init__(self, *args, **kwargs):
+        super(PrefetchAncestorsQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch_ancestors = ()
+
+    def prefetch_ancestors(self, *fields):
+        """Attach ancestors of nodes in `fields` (or of the nodes themselves)
+        when the queryset is evaluated. See `prefetch_ancestors` function.
+        """
+        clone = self._clone()
+        clone._prefetch_ancestors = clone._prefetch_ancestors + (fields, )
+        return clone
+
+    def _clone(self, **kwargs):
+        clone = super(PrefetchAncestorsQuerySet, self)._clone(**kwargs)
+        clone._prefetch_ancestors = self._prefetch_ancestors
+        return clone
+
+    def _fetch_all(self):
+        done = self._result_cache is not None
+        super(PrefetchAncestorsQuerySet, self)._fetch_all()
+        if not done and self._prefetch_ancestors:
+            instances = [obj for obj in self._result_cache if isinstance(obj, models.Model)]
+            for fields in self._prefetch_ancestors:
+                prefetch_ancestors(instances, *fields)
+
+
+class HierarchicalQuerySet(PrefetchAncestorsQuerySet):
+    """QuerySet with tree-wide operations for `HierarchicalModel`."""
+
+    def bulk_create_tree(self, nodes, parent=None, batch_size=1000):
+        """Create a whole (sub)tree using few `bulk_create` queries.
+
+        IDs, levels (and slugs and paths of categories) are computed in memory
+        so the only queries are one or two for free slots under the `parent`
+        (which are reserved, see `HierarchicalModel.reserve_ids`)
+        and the batched inserts which go level by level (parents first).
+
+        :param: `nodes` iterable of nodes where a node is either
+                - a dict of field values with optional "children" key
+                - a tuple (name, slug, children) where slug and children can be omitted
+                - a string - the name
+        :param: `parent` existing instance to create the tree under (None for roots)
+        :rvalue: list of created instances in tree (id) order
+        """
+        from bitcategory.models import LevelFullError
+
+        model = self.model
+        nodes = list(nodes)
+        if not nodes:
+            return []
+        # the only parent which may already have some children, its free
+        # slots are reserved so concurrent writers do not take them
+        reserved = model(parent=parent, level=parent.level + 1 if parent else 1).reserve_ids(
+            len(nodes))
+        try:
+            created = []
+            pending = [(parent, nodes)]
+            while pending:
+                parent_node, children = pending.pop()
+                if not children:
+                    continue
+                level = parent_node.level + 1 if parent_node else 1
+                if parent_node is parent:
+                    ids = reserved
+                else:
+                    layout = model.bit_layout()
+                    slots = layout.slot_masks[level] if level <= layout.depth else 0
+                    if len(children) > slots:
+                        raise LevelFullError(
+                            "Level {0} of {1} can take {2} items, {3} requested".format(
+                                level, model.__name__, slots, len(children)))
+                    ids = [parent_node.pk + slot * layout.steps[level]
+                           for slot in range(1, len(children) + 1)]
+                for pk, child in zip(ids, children):
+                    fields, grandchildren = _parse_node(child)
+                    instance = model(id=pk, parent=parent_node, **fields)
+                    instance.inherit_from(parent_node)
+                    created.append(instance)
+                    pending.append((instance, list(grandchildren)))
+
+            created.sort(key=lambda instance: (instance.level, instance.pk))
+            with transaction.atomic(using=self.db):
+                for start in range(0, len(created), batch_size):
+                    self.bulk_create(created[start:start + batch_size])
+        finally:
+            model.release_ids(reserved)
+        model.bump_tree_version(self.db)
+        created.sort(key=lambda instance: instance.pk)
+        return created
+
+    def delete_subtrees(self, signal=True):
+        """Delete selected nodes with all their descendants (see `delete_ranges`)."""
+        return self.delete_ranges(
+            [self.model.bounds_for(pk) for pk in self.values_list("id", flat=True)], signal)
+
+    def delete_ranges(self, ranges, signal=True):
+        """Delete nodes in [gte, lt) ID `ranges` by one DELETE, bypassing the collector.
+
+        Foreign keys to the nodes are handled by range statements according
+        to their `on_delete` (or the one registered in `bitcategory.references`):
+        CASCADE deletes, SET_NULL updates, PROTECT raises `ProtectedError`
+        before anything is deleted and DO_NOTHING does nothing. No instance
+        signals are sent; `bitcategory.signals.subtree_deleted` is sent once
+        when `signal` is True.
+
+        :rvalue: (total count, {model label: count}) like `QuerySet.delete`
+        """
+        model = self.model
+        ranges = coalesce_ranges(ranges)
+        using = self._db or router.db_for_write(model)
+        parent_field = model._meta.get_field("parent")
+        actions = []
+        for relation in get_candidate_relations_to_delete(model._meta):
+            field = relation.field
+            if field == parent_field:
+                continue
+            related = relation.related_model
+            on_delete = references.on_delete_for(related, field.attname) or \
+                remote_field(field).on_delete
+            rows = related._base_manager.using(using).filter(ranges_q(field.attname, ranges))
+            if on_delete is models.PROTECT:
+                if rows.exists():
+                    raise ProtectedError(
+                        "Cannot delete the subtree because it is referenced through a "
+                        "protected foreign key {0}.{1}".format(related.__name__, field.name),
+                        list(rows[:100]))
+            elif on_delete not in (models.CASCADE, models.SET_NULL, models.DO_NOTHING):
+                raise ValueError("on_delete of {0}.{1} cannot be done by a range statement".format(
+                    related.__name__, field.name))
+            actions.append((on_delete, related, field, rows))
+
+        counts = {}
+        with transaction.atomic(using=using):
+            for on_delete, related, field, rows in actions:
+                if on_delete is models.CASCADE:
+                    if any(get_candidate_relations_to_delete(related._meta)):
+                        # the related rows are referenced too, let the collector follow them
+                        deleted = rows.delete()[1]
+                    else:
+                        deleted = {related._meta.label: rows._raw_delete(using)}
+                    for label, count in deleted.items():
+                        counts[label] = counts.get(label, 0) + count
+                elif on_delete is models.SET_NULL:
+                    rows.update(**{field.name: None})
+            count = model._base_manager.using(using).filter(ranges_q("id", ranges))._raw_delete(using)
+        counts[model._meta.label] = counts.get(model._meta.label, 0) + count
+        model.bump_tree_version(using)
+        if signal:
+            subtree_deleted.send(sender=model, ranges=ranges, count=count, using=using)
+        return sum(counts.values()), dict((label, n) for label, n in counts.items() if n)
+
+    def subtree_counts(self, related, field):
+        """Count `related` objects per node and roll the counts up the tree.
+
+        One GROUP BY query over the foreign key is enough, ancestors are then
+        derived from the bits of every counted ID.
+
+        :param: `related` queryset of a model referencing this one
+        :param: `field` name of the foreign key in the `related` model
+        :rvalue: dict {id: (own count, count including all descendants)}
+        """
+        attname = related.model._meta.get_field(field).attname
+        own = dict(related.order_by().values_list(attname).annotate(count=models.Count("pk")))
+        own.pop(None, None)
+        counts = {}
+        for pk, count in own.items():
+            for ancestor_id in self.model.ancestor_ids_for(pk):
+                counts[ancestor_id] = counts.get(ancestor_id, 0) + count
+        return dict((pk, (own.get(pk, 0), total)) for pk, total in counts.items())
+
+    def annotate_subtree_counts(self, related, field):
+        """Return list of nodes with `own_count` and `subtree_count` attributes.
+
+        Costs two queries no matter how many nodes there are (see `subtree_counts`).
+        """
+        counts = self.subtree_counts(related, field)
+        nodes = list(self)
+        for node in nodes:
+            node.own_count, node.subtree_count = counts.get(node.pk, (0, 0))
+        return nodes
+
+
+def _parse_node(node):
+    """Return (fields, children) of one node passed to `bulk_create_tree`."""
+    if isinstance(node, dict):
+        fields = dict(node)
+        return fields, fields.pop("children", None) or ()
+    if isinstance(node, six.string_types):
+        return {"name": node}, ()
+    name, slug, children = (tuple(node) + (None, None))[:3]
+    fields = {"name": name}
+    if slug:
+        fields["slug"] = slug
+    return fields, children or ()
+
+
+class PrefetchAncestorsManager(models.Manager.from_queryset(PrefetchAncestorsQuerySet)):
+    pass
+
+
+class HierarchicalManager(models.Manager.from_queryset(HierarchicalQuerySet)):
+    pass
@@ -1,10 +1,81 @@
 from __future__ import division
 
-from django.db import models
+import datetime
+import time
+
+import six
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import F, Value, Case, When
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.template.defaultfilters import slugify
 
+from bitcategory import references
+from bitcategory.compat import set_cached_related
+from bitcategory.fields import HierarchicalIdField
+from bitcategory.instrumentation import instrumented
+from bitcategory.layout import BitLayout
+from bitcategory.managers import HierarchicalManager
+from bitcategory.paths import get_path_index
+from bitcategory.snapshot import get_snapshot
 
-class HierarchicalModel(models.Model):
+if six.PY3:
+    from bitcategory.aio import AsyncHierarchicalMixin
+else:
+    class AsyncHierarchicalMixin(object):
+        """Async methods need Python 3."""
+
+
+def get_cache():
+    """Return cache used for sharing tree versions (``BITCATEGORY_CACHE``)."""
+    return caches[getattr(settings, "BITCATEGORY_CACHE", "default")]
+
+
+class LevelFullError(ValueError):
+    """There is no free slot left in a level of the tree."""
+
+
+def free_slots(bitmap, slots, count=1):
+    """Return up to `count` lowest slot numbers which are not set in `bitmap`.
+
+    Slot 0 is never free because such ID would equal to the parent's one.
+    """
+    free = ~(bitmap | 1) & ((1 << slots) - 1)
+    result = []
+    while free and len(result) < count:
+        lowest = free & -free
+        result.append(lowest.bit_length() - 1)
+        free ^= lowest
+    return result
+
+
+def shift_range(field, old, new, layout, old_level, new_level, depth):
+    """Expression moving IDs in `field` from subtree `old` to subtree `new`.
+
+    Blocks of levels `old_level + k` are moved to `new_level + k` for all the
+    `depth` levels of the subtree. When the widths of those levels are the
+    same it is a simple shift, otherwise every block is placed separately.
+    """
+    offset = F(field) - old
+    if all(layout.widths[old_level + k] == layout.widths[new_level + k] for k in range(1, depth)):
+        shift = layout.right_offsets[old_level] - layout.right_offsets[new_level]
+        if shift > 0:
+            offset = offset / (1 << shift)
+        elif shift < 0:
+            offset = offset * (1 << -shift)
+        return offset + new
+    blocks = [offset / layout.steps[old_level + k] % (1 << layout.widths[old_level + k]) *
+              layout.steps[new_level + k] for k in range(1, depth)]
+    expression = blocks[0]
+    for block in blocks[1:]:
+        expression = expression + block
+    return expression + new
+
+
+class HierarchicalModel(AsyncHierarchicalMixin, models.Model):
     """
     Model which keeps tree-like structure using bitwise primary key.
 
@@ -13,12 +84,18 @@ class HierarchicalModel(models.Model):
     :param:`ID_BIT_WIDTH` int how many bits the ID has (32 or 64)
     :param:`LEVEL_BIT_WIDTH` int how many bits should one level have. It does not need
         to be a divisor of `ID_BIT_WIDTH`. The level can take 2^LEVEL_BIT_WIDTH items.
+    :param:`LAYOUT` optional `bitcategory.layout.BitLayout` with own width of every
+        level. It takes precedence over the two above; IDs of 32 and more bits
+        are stored in BigIntegerField.
     :param:`level` int default 1
     """
     ID_BIT_WIDTH = 32
     LEVEL_BIT_WIDTH = 5
+    LAYOUT = None
+    ALLOCATION_RETRIES = 10
+    LOCK_PARENT = False
 
-    id = models.IntegerField(primary_key=True)
+    id = HierarchicalIdField(primary_key=True)
     parent = models.ForeignKey('self', related_name="children", null=True, blank=True)
     level = models.PositiveSmallIntegerField(default=1)
     ordering = models.SmallIntegerField(default=0)
@@ -26,13 +103,172 @@ class HierarchicalModel(models.Model):
     class Meta:
         abstract = True
 
+    objects = HierarchicalManager()
+
+    @instrumented("HierarchicalModel.save")
     def save(self, *args, **kwargs):
-        """Update level and assign next free id."""
-        self.level = self.parent.level + 1 if self.parent else 1
-        if not self.id:
-            self.id = self.get_free_id()
-            kwargs.update(force_insert=True)
-        super(HierarchicalModel, self).save(*args, **kwargs)
+        """Update level and assign next free id.
+
+        New IDs are reserved (see `reserve_ids`) so concurrent writers do not
+        pick the same one. If an ID gets taken anyway (by a writer in another
+        process without a shared cache), the insert is retried with fresh
+        occupancy up to `ALLOCATION_RETRIES` times. With `LOCK_PARENT` the
+        parent row is locked by SELECT FOR UPDATE while the ID is picked.
+        """
+        self.inherit_from(self.parent)
+        self.__dict__.pop("_ancestors_cache", None)  # the parent may have changed
+        if self.id:
+            return super(HierarchicalModel, self).save(*args, **kwargs)
+        kwargs.update(force_insert=True)
+        using = kwargs.get("using") or router.db_for_write(self.__class__, instance=self)
+        manager = self.__class__._default_manager.using(using)
+        for attempt in range(self.ALLOCATION_RETRIES):
+            pk = None
+            if not self.LOCK_PARENT:
+                # outside of the transaction so SQLite does not need to upgrade a read lock
+                pk = self.id = self.reserve_ids(1)[0]
+            try:
+                with transaction.atomic(using=using):
+                    if self.LOCK_PARENT:
+                        if self.parent_id is not None:
+                            list(manager.select_for_update().filter(pk=self.parent_id).values_list("pk"))
+                        pk = self.id = self.reserve_ids(1)[0]
+                    super(HierarchicalModel, self).save(*args, **kwargs)
+                return
+            except IntegrityError:
+                self.id = None
+                # give up on other integrity errors or when the ID is taken again and again
+                if attempt + 1 == self.ALLOCATION_RETRIES or not manager.filter(pk=pk).exists():
+                    raise
+            finally:
+                if pk is not None:
+                    self.release_ids([pk])
+
+    def inherit_from(self, parent):
+        """Set fields derived from the `parent` instance (without any query)."""
+        self.level = parent.level + 1 if parent else 1
+
+    @classmethod
+    def _version_key(cls):
+        opts = cls._meta.concrete_model._meta
+        return "bitcategory:version:{0}.{1}".format(opts.app_label, opts.model_name)
+
+    @classmethod
+    def tree_version(cls):
+        """Return version of the tree shared by all processes using the cache."""
+        cache = get_cache()
+        key = cls._version_key()
+        version = cache.get(key)
+        if version is None:
+            # start from time so an evicted counter does not repeat old values
+            version = int(time.time() * 1000)
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+        return version
+
+    @classmethod
+    def bump_tree_version(cls, using=None):
+        """Mark the tree as changed. Called automatically on save/delete.
+
+        Inside a transaction on the database `using` the version is bumped
+        at once (so the writer's own reads are fresh) and once more when the
+        transaction commits. Otherwise other processes could cache the old
+        rows under the new version in the meantime and keep them until the
+        next change.
+        """
+        using = using or router.db_for_write(cls)
+        if transaction.get_connection(using).in_atomic_block:
+            transaction.on_commit(cls._increment_tree_version, using=using)
+        return cls._increment_tree_version()
+
+    @classmethod
+    def _increment_tree_version(cls):
+        cache = get_cache()
+        key = cls._version_key()
+        cache.set(key + ":modified", time.time(), None)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            version = int(time.time() * 1000)
+            cache.set(key, version, None)
+            return version
+
+    @classmethod
+    def tree_modified(cls):
+        """Return UTC datetime of the last change of the tree (as known by the cache)."""
+        cache = get_cache()
+        key = cls._version_key() + ":modified"
+        modified = cache.get(key)
+        if modified is None:
+            modified = time.time()
+            if not cache.add(key, modified, None):
+                modified = cache.get(key, modified)
+        return datetime.datetime.utcfromtimestamp(int(modified))
+
+    @classmethod
+    def tree_snapshot(cls):
+        """Return in-memory snapshot of the whole tree (see `bitcategory.snapshot`).
+
+        The snapshot is loaded by one query and reloaded lazily once the tree
+        version changes.
+        """
+        return get_snapshot(cls)
+
+    @classmethod
+    def bit_layout(cls):
+        """Return `BitLayout` of the IDs (computed once per class)."""
+        layout = cls.__dict__.get("_bit_layout")
+        if layout is None:
+            layout = cls.LAYOUT or BitLayout.uniform(cls.LEVEL_BIT_WIDTH, cls.ID_BIT_WIDTH)
+            cls._bit_layout = layout
+        return layout
+
+    @classmethod
+    def level_from_id(cls, pk):
+        """Return level of a node computed only from its ID."""
+        return cls.bit_layout().level_of(pk)
+
+    @classmethod
+    def bounds_for(cls, pk):
+        """Return (gte, lt) bounds of descendant IDs of the node with given ID."""
+        return cls.bit_layout().bounds(pk)
+
+    @classmethod
+    def ancestor_ids_for(cls, pk):
+        """Return IDs of all ancestors including itself ordered from the root."""
+        return cls.bit_layout().ancestors(pk)
+
+    @classmethod
+    def parent_id_for(cls, pk):
+        """Return ID of the parent computed only from the ID (None for roots)."""
+        return cls.bit_layout().parent(pk)
+
+    @classmethod
+    def is_valid_id(cls, pk):
+        """Test whether `pk` is a well formed ID (without asking the database).
+
+        The ID has to fit into the layout, it's lowest set bit has to be in
+        an existing level and none of its ancestor levels can be empty.
+        """
+        return cls.bit_layout().is_valid(pk)
+
+    @classmethod
+    def lazy_instance(cls, pk, using=None):
+        """Return an instance with only the ID loaded, other fields are deferred.
+
+        Deferred fields are loaded from the database on first access.
+        """
+        fields = cls._meta.concrete_fields
+        using = using or router.db_for_read(cls)
+        try:
+            from django.db.models.query_utils import deferred_class_factory
+        except ImportError:  # Django >= 1.10
+            from django.db.models.base import DEFERRED
+            return cls.from_db(using, [field.attname for field in fields],
+                               [pk if field.primary_key else DEFERRED for field in fields])
+        model = deferred_class_factory(cls, [field.attname for field in fields
+                                             if not field.primary_key])
+        return model.from_db(using, [cls._meta.pk.attname], [pk])
 
     def __contains__(self, other):
         """Test whether a category is a subcategory of the other.
@@ -43,7 +279,7 @@ class HierarchicalModel(models.Model):
 
         !Right associative! "key" in dict -> dict.__contain__("key")
         """
-        mask = self._mask_for(self.level)
+        mask = self.bit_layout().masks[self.level]
         return (other.id >= self.id) and ((self.id & mask) == (other.id & mask))
 
     @property
@@ -54,25 +290,57 @@ class HierarchicalModel(models.Model):
     @property
     def lt(self):
         """Upper exclusive bound for descendant IDs."""
-        return self.id + self.min
+        return self.id + self.bit_layout().steps[self.level]
+
+    @property
+    def ancestor_ids(self):
+        """IDs of all ancestors including itself ordered from the root (no query)."""
+        return self.bit_layout().ancestors(self.id)
+
+    @property
+    def root_id(self):
+        """ID of the root of this node (no query)."""
+        return self.id & self.bit_layout().masks[1]
+
+    @property
+    def parent_id_from_bits(self):
+        """ID of the parent computed from the ID (no query, None for roots)."""
+        return self.bit_layout().parent(self.id)
+
+    @property
+    def slot_index(self):
+        """Position of the node among its siblings' slots (1 for the first slot)."""
+        layout = self.bit_layout()
+        return layout.slot(self.id, layout.level_of(self.id))
 
     @property
+    @instrumented("HierarchicalModel.ancestors", queries=False)
     def ancestors(self):
-        """Select all ancestors including itself in a queryset."""
-        ids = map(lambda level: self._mask_for(level) & self.id, range(self.level, 0, -1))
-        return self.__class__.objects.filter(id__in=ids)
+        """Select all ancestors including itself in a queryset ordered from the root.
+
+        Ancestors loaded by `prefetch_ancestors` are returned without a query.
+        """
+        queryset = self.__class__.objects.filter(id__in=self.ancestor_ids).order_by("id")
+        cached = self.__dict__.get("_ancestors_cache")
+        if cached is not None:
+            queryset._result_cache = list(cached)
+            queryset._prefetch_done = True
+        return queryset
 
     @property
+    @instrumented("HierarchicalModel.descendants", queries=False)
     def descendants(self):
         """Select all descendants including itself in a queryset."""
         return self.__class__.objects.filter(id__gte=self.gte, id__lt=self.lt)
 
     @property
+    @instrumented("HierarchicalModel.neighbours", queries=False)
     def neighbours(self):
         """Select all neighbours including itself in a queryset."""
-        return self.__class__.objects.filter(parent=self.parent)
+        return self.__class__.objects.filter(parent_id=self.parent_id)
 
     @property
+    @instrumented("HierarchicalModel.first_child")
     def first_child(self):
         """Select first child."""
         try:
@@ -81,9 +349,64 @@ class HierarchicalModel(models.Model):
             return None
 
     @property
+    @instrumented("HierarchicalModel.root")
     def root(self):
-        """Return root node from DB."""
-        return self.__class__.objects.get(pk=self.id & self._mask_for(1))
+        """Return root node from DB (or itself without a query when it is a root)."""
+        if self.root_id == self.id:
+            return self
+        if "_ancestors_cache" in self.__dict__:
+            return self._ancestors_cache[0]
+        return self.__class__.objects.get(pk=self.root_id)
+
+    def _subtree(self, max_depth=None):
+        queryset = self.descendants
+        if max_depth is not None:
+            queryset = queryset.filter(level__lte=self.level + max_depth)
+        return queryset
+
+    def load_subtree(self, max_depth=None):
+        """Load descendants by one range query and link them in memory.
+
+        `children.all()` of every loaded node (and `parent` of its children) is
+        then answered without a query. Nodes in the `max_depth` level below
+        this one keep their children unloaded.
+
+        :rvalue: the node itself
+        """
+        nodes = {self.id: self}
+        children = {self.id: []}
+        for node in self._subtree(max_depth).exclude(id=self.id).order_by("id"):
+            parent = nodes[node.parent_id]
+            children[parent.id].append(node)
+            set_cached_related(node, node._meta.get_field("parent"), parent)
+            nodes[node.id] = node
+            if max_depth is None or node.level < self.level + max_depth:
+                children[node.id] = []
+        for pk, node_children in children.items():
+            cache = nodes[pk].__dict__.setdefault("_prefetched_objects_cache", {})
+            cache.pop("children", None)
+            queryset = nodes[pk].children.get_queryset()
+            queryset._result_cache = node_children
+            queryset._prefetch_done = True
+            cache["children"] = queryset
+        return self
+
+    def iter_dfs(self, max_depth=None):
+        """Iterate over the subtree (itself included) depth-first in pre-order.
+
+        It is just the ID order, so nodes are streamed by `iterator()` of one
+        query and never held all at once.
+        """
+        return self._subtree(max_depth).order_by("id").iterator()
+
+    def iter_bfs(self, max_depth=None):
+        """Iterate over the subtree (itself included) breadth-first by one streamed query."""
+        return self._subtree(max_depth).order_by("level", "id").iterator()
+
+    def walk(self, max_depth=None):
+        """Iterate depth-first over (node, depth) where depth of this node is 0."""
+        for node in self.iter_dfs(max_depth):
+            yield node, node.level - self.level
 
     @property
     def min(self):
@@ -93,7 +416,7 @@ class HierarchicalModel(models.Model):
     @property
     def max(self):
         """Maximal value for given (sub) level."""
-        return (2 ** self.__class__.LEVEL_BIT_WIDTH - 1) << self._get_right_offset()
+        return self.bit_layout().slot_masks[self.level] << self._get_right_offset()
 
     def __gt__(self, other):
         """State if the other is a child of self.
@@ -106,40 +429,197 @@ class HierarchicalModel(models.Model):
             raise ValueError("Compare only HierarchicalModels ancestors")
         if self.id is None or other.id is None:
             raise ValueError("Cannot compare unsaved HierarchicalModel")
-        return (self.id == (other.id & self._mask_for(self.level)))
+        return (self.id == (other.id & self.bit_layout().masks[self.level]))
 
     def __eq__(self, other):
-        if not isinstance(other, self.__class__):
+        # compare concrete models so deferred instances equal to the full ones
+        if not isinstance(other, models.Model) or \
+                self._meta.concrete_model != other._meta.concrete_model:
             return False
         return self.id == other.id
 
+    __hash__ = models.Model.__hash__
+
     def get_free_id(self):
         """Returns next free ID in database evaluating spaces made by deleted items"""
-        step = self.min
-        if not self.parent:
-            pks = sorted(self.__class__.objects.filter(parent__isnull=True).values_list("id", flat=True))
-            minimum = step
-        else:
-            minimum = self.parent.id + step
-            pks = sorted(self.parent.children.values_list("id", flat=True))
-        if not pks:
-            return minimum
-        for i, pk in enumerate(pks):
-            if pk != i*step + minimum:
-                return i*step + minimum
-        return pks[-1] + step
+        return self.get_free_ids(1)[0]
+
+    @instrumented("HierarchicalModel.get_free_ids")
+    def get_free_ids(self, count):
+        """Return `count` lowest free IDs among the siblings.
+
+        Siblings are folded into an occupancy bitmap (one bit per slot) and
+        the free slots are picked by bit tricks. When the siblings fill the
+        slots from the first one without gaps, the IDs simply follow the last
+        sibling and the bitmap is not built at all.
+
+        :raises: `LevelFullError` when there are not enough free slots
+        """
+        siblings = self._siblings()
+        stats = siblings.aggregate(used=models.Count("id"), last=models.Max("id"))
+        free = self._following_ids(stats, count)
+        if free is None:
+            free = self._free_ids_in(siblings.values_list("id", flat=True), stats["used"], count)
+        return free
+
+    def _siblings(self):
+        if self._get_right_offset() < 0:
+            raise LevelFullError("There are no bits left for level {0} of {1}".format(
+                self.level, self.__class__.__name__))
+        return self.__class__.objects.filter(parent_id=self.parent_id)
+
+    def _following_ids(self, stats, count):
+        """IDs after the last sibling if siblings take slots without gaps (else None)."""
+        offset = self._get_right_offset()
+        slots = 1 << self.bit_layout().widths[self.level]
+        base = self.parent_id or 0
+        used, last_slot = stats["used"], ((stats["last"] or base) - base) >> offset
+        if used == last_slot and last_slot + count < slots:
+            return [base + (slot << offset) for slot in range(last_slot + 1, last_slot + count + 1)]
+        return None
+
+    def _free_ids_in(self, sibling_ids, used, count):
+        """Pick `count` lowest free IDs from an occupancy bitmap of `sibling_ids`."""
+        offset = self._get_right_offset()
+        slots = 1 << self.bit_layout().widths[self.level]
+        base = self.parent_id or 0
+        bitmap = 0
+        for pk in sibling_ids:
+            bitmap |= 1 << ((pk - base) >> offset)
+        free = free_slots(bitmap, slots, count)
+        if len(free) < count:
+            raise LevelFullError(
+                "Level {0} of {1} under parent {2} is full: {3} of {4} slots taken, "
+                "{5} requested".format(self.level, self.__class__.__name__, self.parent_id,
+                                       used, slots - 1, count))
+        return [base + (slot << offset) for slot in free]
+
+    def reserve_ids(self, count, timeout=None):
+        """Reserve `count` lowest free IDs among the siblings for a while.
+
+        Reserved IDs are skipped by other `reserve_ids` calls (and so by `save`)
+        in all processes sharing the cache, until they are released or the
+        reservation expires after `timeout` seconds (setting
+        ``BITCATEGORY_RESERVATION_TIMEOUT``, 60 by default). Bulk writers can
+        fill the reserved IDs without further coordination::
+
+            ids = MyCategory(parent=parent).reserve_ids(100)
+            MyCategory.objects.bulk_create([MyCategory(id=pk, parent=parent, ...) for pk in ids])
+
+        :raises: `LevelFullError` when there are not enough free slots
+        """
+        self.level = self.level_from_id(self.parent_id) + 1 if self.parent_id else 1
+        if timeout is None:
+            timeout = getattr(settings, "BITCATEGORY_RESERVATION_TIMEOUT", 60)
+        cache = get_cache()
+        prefix = self._version_key() + ":reserved:"
+        reserved, refused = [], set()
+        try:
+            while len(reserved) < count:
+                for pk in self.get_free_ids(count + len(refused)):
+                    if pk in refused or pk in reserved:
+                        continue
+                    if cache.add(prefix + str(pk), True, timeout):
+                        reserved.append(pk)
+                    else:
+                        refused.add(pk)
+                    if len(reserved) == count:
+                        break
+        except LevelFullError:
+            self.release_ids(reserved)
+            raise
+        return sorted(reserved)
+
+    @classmethod
+    def release_ids(cls, ids):
+        """Release IDs reserved by `reserve_ids` (used or not)."""
+        prefix = cls._version_key() + ":reserved:"
+        get_cache().delete_many([prefix + str(pk) for pk in ids])
+
+    def delete_subtree(self, signal=True):
+        """Delete the node with all descendants by one range DELETE.
+
+        Unlike `delete` it does not load the descendants and does not send
+        per-instance signals (see `HierarchicalQuerySet.delete_ranges`).
+
+        :rvalue: (total count, {model label: count}) like `delete`
+        """
+        result = self.__class__.objects.using(router.db_for_write(self.__class__, instance=self)) \
+            .delete_ranges([(self.gte, self.lt)], signal)
+        self.id = None
+        return result
+
+    def move_to(self, parent, ignore_unregistered=False):
+        """Move the node with all its descendants under the `parent` (None makes a root).
+
+        The node gets the lowest free ID under the new parent and the IDs of
+        the whole subtree are rewritten by one arithmetic UPDATE. Foreign keys
+        of models registered in `bitcategory.references` are remapped the same
+        way within one transaction. Other instances of the moved descendants
+        held in memory become stale.
+
+        :param: `ignore_unregistered` move even when there are foreign keys to
+                the tree not registered in `bitcategory.references` (their rows
+                keep the old IDs)
+        :raises: `ValueError` when there are unregistered foreign keys
+        """
+        if parent is not None and parent in self:
+            raise ValueError("Cannot move a node under itself or its descendant")
+        parent_id = parent.pk if parent is not None else None
+        if parent_id == self.parent_id:
+            return
+        model = self.__class__
+        if not ignore_unregistered:
+            references.check_registered(model)
+        layout = self.bit_layout()
+        level = parent.level + 1 if parent is not None else 1
+        with transaction.atomic(using=router.db_for_write(model)):
+            depth = self.descendants.aggregate(level=models.Max("level"))["level"] - self.level + 1
+            if level + depth - 1 > layout.depth or any(
+                    layout.widths[level + k] < layout.widths[self.level + k] for k in range(1, depth)):
+                raise LevelFullError(
+                    "Subtree of {0} is {1} levels deep, it does not fit under {2}".format(
+                        self.pk, depth, parent_id))
+            new_id = model(parent=parent, level=level).get_free_id()
+
+            def shift(field):
+                return shift_range(field, self.id, new_id, layout, self.level, level, depth)
+            # every assignment reads only its own column, so it does not matter that
+            # MySQL evaluates them left to right with the already updated values;
+            # only the moved node has its parent outside of the subtree
+            self.descendants.update(
+                id=shift("id"),
+                parent_id=Case(When(parent_id=self.parent_id, then=Value(parent_id)),
+                               default=shift("parent_id"),
+                               output_field=models.BigIntegerField()),
+                level=F("level") + (level - self.level))
+            for ref_model, attname in references.references_to(model):
+                ref_model._default_manager.filter(**{
+                    attname + "__gte": self.gte, attname + "__lt": self.lt,
+                }).update(**{attname: shift(attname)})
+            self.id = new_id
+            self.parent = parent
+            self.__dict__.pop("_ancestors_cache", None)
+            self.inherit_from(parent)
+        model.bump_tree_version(router.db_for_write(model))
 
     def _get_left_offset(self, level=None):
         """Return number of offset bits in current/given level from left."""
-        return (level or self.level) * self.__class__.LEVEL_BIT_WIDTH
+        return self.bit_layout().left_offset(level or self.level)
 
     def _get_right_offset(self, level=None):
         """Return number of offset bits in current/given level from right."""
-        return self.__class__.ID_BIT_WIDTH - self._get_left_offset(level)
+        return self.bit_layout().right_offset(level or self.level)
 
     def _mask_for(self, level):
         """Return mask with 1 where are the significant bits (1 from left)."""
-        return (2 ** self._get_left_offset(level) - 1) << (self._get_right_offset(level))
+        return self.bit_layout().masks[level]
+
+
+@receiver([post_save, post_delete])
+def _bump_tree_version(sender, instance, using=None, **kwargs):
+    if isinstance(instance, HierarchicalModel):
+        sender.bump_tree_version(using)
 
 
 class CategoryBase(HierarchicalModel):
@@ -155,17 +635,110 @@ class CategoryBase(HierarchicalModel):
     def __str__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
+    def inherit_from(self, parent):
+        """Update level, slug and path (every time)."""
+        super(CategoryBase, self).inherit_from(parent)
         if not self.slug:
             self.slug = slugify(self.name)
-        # update path every time
         new_path = self.slug
-        if self.parent:
-            new_path = "/".join((self.parent.path.strip("/"), self.slug))
+        if parent:
+            new_path = "/".join((parent.path.strip("/"), self.slug))
         if self.path != new_path:
             self.path = new_path
-        super(CategoryBase, self).save(*args, **kwargs)
 
+    def save(self, *args, **kwargs):
+        """Save and propagate changed path (after renaming) to all descendants."""
+        if self._state.adding:
+            return super(CategoryBase, self).save(*args, **kwargs)
+        old_path = self.path
+        with transaction.atomic(using=router.db_for_write(self.__class__)):
+            super(CategoryBase, self).save(*args, **kwargs)
+            if old_path and old_path != self.path:
+                self.rewrite_paths(old_path)
+
+    def move_to(self, parent, ignore_unregistered=False):
+        """Move the subtree and rewrite paths of all the moved categories."""
+        old_path = self.path
+        with transaction.atomic(using=router.db_for_write(self.__class__)):
+            super(CategoryBase, self).move_to(parent, ignore_unregistered)
+            self.rewrite_paths(old_path)
+
+    def rewrite_paths(self, old_path):
+        """Replace `old_path` prefix by the current path in the whole subtree.
+
+        All the paths are changed by one UPDATE directly in the database.
+        """
+        self.descendants.update(path=Case(
+            When(id=self.id, then=Value(self.path)),
+            default=Concat(Value(self.path), Substr("path", len(old_path) + 1)),
+            output_field=models.CharField()))
+        self.__class__.bump_tree_version(router.db_for_write(self.__class__))
+
+    @classmethod
+    def rebuild_paths(cls, batch_size=500):
+        """Regenerate paths of the whole table from slugs.
+
+        Levels are processed from the roots down, keeping only paths of the
+        previous level in memory. Changed paths are written by batched
+        UPDATEs (one CASE statement per batch).
+
+        :rvalue: number of updated categories
+        """
+        updated = 0
+        parent_paths = {}
+        level = 1
+        with transaction.atomic(using=router.db_for_write(cls)):
+            while True:
+                rows = cls.objects.filter(level=level).order_by("id").values_list(
+                    "id", "parent_id", "slug", "path")
+                paths, changed = {}, []
+                for pk, parent_id, slug, path in rows.iterator():
+                    paths[pk] = slug
+                    if parent_id is not None:
+                        paths[pk] = "/".join((parent_paths[parent_id].strip("/"), slug))
+                    if paths[pk] != path:
+                        changed.append(pk)
+                if not paths:
+                    break
+                for start in range(0, len(changed), batch_size):
+                    batch = changed[start:start + batch_size]
+                    cls.objects.filter(id__in=batch).update(path=Case(
+                        *[When(id=pk, then=Value(paths[pk])) for pk in batch],
+                        output_field=models.CharField()))
+                updated += len(changed)
+                parent_paths = paths
+                level += 1
+        if updated:
+            cls.bump_tree_version(router.db_for_write(cls))
+        return updated
+
+    @classmethod
+    @instrumented("CategoryBase.resolve_paths")
+    def resolve_paths(cls, paths):
+        """Return {path: ID} of categories with given paths (missing ones are left out).
+
+        Paths are cached in the memory of the process until the tree changes
+        (see `bitcategory.paths`), unknown ones are loaded by one query.
+        Leading and trailing slashes are ignored.
+        """
+        return get_path_index(cls).resolve(paths)
+
+    @classmethod
+    def resolve_path(cls, path):
+        """Return ID of the category with `path` or None (usually without a query)."""
+        return cls.resolve_paths([path]).get(path.strip("/"))
+
+    @classmethod
+    @instrumented("CategoryBase.paths_for")
+    def paths_for(cls, pks):
+        """Return {ID: path} of existing categories composed from slugs of ancestors.
+
+        The stored `path` column is not read; slugs missing in the cache are
+        loaded by one query.
+        """
+        return get_path_index(cls).paths_for(pks)
+
+    @instrumented("CategoryBase.full_name")
     def full_name(self):
         """Compose name of the names of all ancestors."""
         return " - ".join(ancestor.name for ancestor in self.ancestors)
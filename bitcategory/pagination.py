@@ -0,0 +1,160 @@
+#coding: utf-8
+"""Keyset pagination of objects in a category subtree.
+
+Objects referencing a subtree are ordered by (category ID, primary key). A
+page does not use OFFSET, it continues right after (or before) the key of
+the last (first) object of the previous page, so deep pages cost the same
+as the first one when there is a matching composite index::
+
+    class MyProduct(models.Model):
+        category = models.ForeignKey(MyCategory)
+
+        class Meta:
+            index_together = [subtree_index("category")]
+            # or indexes = [subtree_model_index("category")] in Django >= 1.11
+
+    paginator = SubtreePaginator(MyProduct.objects.all(), "category", category, per_page=20)
+    page = paginator.page(request.GET.get("cursor"))
+    ... page.next_cursor() ...
+
+Cursors are opaque URL-safe strings.
+"""
+import base64
+try:
+    from collections.abc import Sequence
+except ImportError:  # Python 2
+    from collections import Sequence
+
+from django.core.paginator import InvalidPage
+from django.db import models
+from django.db.models import Q
+from django.utils.encoding import force_bytes, force_text
+from django.utils.functional import cached_property
+
+from bitcategory.compat import remote_model
+from bitcategory.lookups import _nodes, _pk, coalesce_ranges, ranges_q
+
+
+def subtree_index(field_name, pk_name="id"):
+    """Return fields of composite index used by `SubtreePaginator` for `Meta.index_together`."""
+    return (field_name, pk_name)
+
+
+def subtree_model_index(field_name, name=None, pk_name="id"):
+    """Return the index of `subtree_index` as `models.Index` for `Meta.indexes` (Django >= 1.11)."""
+    return models.Index(fields=list(subtree_index(field_name, pk_name)),
+                        name=name or "{0}_{1}_subtree".format(field_name, pk_name)[:30])
+
+
+class SubtreePaginator(object):
+    """
+    Paginate `queryset` of objects whose foreign key `field` points into subtrees of `nodes`.
+
+    :param: `queryset` queryset of the referencing model (it may be filtered)
+    :param: `field` name of the foreign key to a hierarchical model
+    :param: `nodes` a node or an iterable of nodes (instances or IDs)
+    :param: `per_page` number of objects on a page
+    """
+    def __init__(self, queryset, field, nodes, per_page):
+        self.queryset = queryset
+        self.field = queryset.model._meta.get_field(field)
+        self.per_page = int(per_page)
+        tree_model = remote_model(self.field)
+        self.ranges = coalesce_ranges(tree_model.bounds_for(_pk(node)) for node in _nodes(nodes))
+
+    @cached_property
+    def object_list(self):
+        """Objects of all pages ordered by (foreign key, pk)."""
+        attname = self.field.attname
+        if not self.ranges:
+            return self.queryset.none()
+        return self.queryset.filter(ranges_q(attname, self.ranges)).order_by(attname, "pk")
+
+    @cached_property
+    def count(self):
+        """Total number of objects (one COUNT query over the ranges)."""
+        return self.object_list.count()
+
+    def page(self, cursor=None):
+        """Return the page given by `cursor` (None for the first one)."""
+        if not cursor:
+            return self._page(self.object_list[:self.per_page + 1], forward=True, after=False)
+        direction, key = decode_cursor(cursor)
+        attname = self.field.attname
+        if direction == "n":
+            objects = self.object_list.filter(
+                Q(**{attname + "__gt": key[0]}) | Q(**{attname: key[0], "pk__gt": key[1]}))
+        else:
+            objects = self.object_list.filter(
+                Q(**{attname + "__lt": key[0]}) | Q(**{attname: key[0], "pk__lt": key[1]})
+            ).order_by("-" + attname, "-pk")
+        return self._page(objects[:self.per_page + 1], forward=direction == "n", after=True)
+
+    def _page(self, objects, forward, after):
+        objects = list(objects)
+        more = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        if not forward:
+            objects.reverse()
+        return SubtreePage(objects, self,
+                           has_next=more if forward else after,
+                           has_previous=after if forward else more)
+
+
+class SubtreePage(Sequence):
+    """Page of `SubtreePaginator` with Django's `Page` interface besides numbers."""
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __repr__(self):
+        return "<Page of {0} objects>".format(len(self.object_list))
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def next_cursor(self):
+        if not self._has_next:
+            return None
+        return encode_cursor("n", self._key(self.object_list[-1]))
+
+    def previous_cursor(self):
+        if not self._has_previous:
+            return None
+        return encode_cursor("p", self._key(self.object_list[0]))
+
+    def _key(self, obj):
+        return getattr(obj, self.paginator.field.attname), obj.pk
+
+
+def encode_cursor(direction, key):
+    """Encode direction ("n" or "p") and (foreign key, pk) into an opaque string."""
+    raw = "{0}:{1}:{2}".format(direction, key[0], key[1])
+    return force_text(base64.urlsafe_b64encode(force_bytes(raw))).rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return (direction, (foreign key, pk)) of a cursor or raise `InvalidPage`."""
+    try:
+        raw = force_text(base64.urlsafe_b64decode(force_bytes(cursor + "=" * (-len(cursor) % 4))))
+        direction, fk, pk = raw.split(":")
+        if direction not in ("n", "p"):
+            raise ValueError(direction)
+        return direction, (int(fk), int(pk))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise InvalidPage("Invalid cursor")
@@ -0,0 +1,139 @@
+#coding: utf-8
+"""Cached resolution of category paths to IDs and back.
+
+Every category model has one `PathIndex` kept in the memory of the process.
+It is a bounded LRU (``BITCATEGORY_PATH_CACHE_SIZE`` entries of each kind,
+10000 by default) which is dropped whenever the tree version changes, so it
+is never stale. Use it through `CategoryBase`::
+
+    MyCategory.resolve_path("books/fiction")        # -> ID or None
+    MyCategory.resolve_paths(paths_from_sitemap)    # -> {path: ID}
+    MyCategory.paths_for(ids)                       # -> {ID: path} built from slugs
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import router
+
+_indexes = {}
+_lock = threading.Lock()
+_MISSING = object()
+
+
+def get_path_index(model):
+    """Return `PathIndex` of the (concrete) category `model`."""
+    model = model._meta.concrete_model
+    index = _indexes.get(model)
+    if index is None:
+        with _lock:
+            index = _indexes.setdefault(model, PathIndex(
+                model, getattr(settings, "BITCATEGORY_PATH_CACHE_SIZE", 10000)))
+    return index
+
+
+def invalidate_path_index(model):
+    """Drop the path index of `model` held by this process."""
+    _indexes.pop(model._meta.concrete_model, None)
+
+
+def normalize_path(path):
+    return path.strip("/")
+
+
+class PathIndex(object):
+    """LRU maps path -> ID and ID -> path valid for one version of the tree."""
+
+    def __init__(self, model, size):
+        self.model = model
+        self.size = size
+        self.lock = threading.Lock()
+        self.version = None
+        self.ids = OrderedDict()
+        self.paths = OrderedDict()
+
+    def _rows(self):
+        return self.model._default_manager.using(router.db_for_read(self.model))
+
+    def _current_version(self):
+        """Drop everything if the tree changed and return the current version."""
+        version = self.model.tree_version()
+        with self.lock:
+            if version != self.version:
+                self.ids.clear()
+                self.paths.clear()
+                self.version = version
+        return version
+
+    def _lookup(self, mapping, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                value = mapping.pop(key, _MISSING)
+                if value is not _MISSING:
+                    mapping[key] = value  # most recently used goes last
+                    found[key] = value
+        return found
+
+    def _store(self, version, pairs):
+        """Store (path, ID) pairs (ID None for missing paths) loaded for `version`."""
+        with self.lock:
+            if version != self.version:
+                return
+            for path, pk in pairs:
+                self.ids.pop(path, None)
+                self.ids[path] = pk
+                if pk is not None:
+                    self.paths.pop(pk, None)
+                    self.paths[pk] = path
+            for mapping in (self.ids, self.paths):
+                while len(mapping) > self.size:
+                    mapping.popitem(last=False)
+
+    def resolve(self, paths):
+        """Return {path: ID} of existing `paths` loading unknown ones by one query."""
+        version = self._current_version()
+        paths = set(normalize_path(path) for path in paths)
+        found = self._lookup(self.ids, paths)
+        missing = paths.difference(found)
+        if missing:
+            loaded = dict(self._rows().filter(path__in=missing).values_list("path", "id"))
+            self._store(version, [(path, loaded.get(path)) for path in missing])
+            found.update(loaded)
+        return dict((path, pk) for path, pk in found.items() if pk is not None)
+
+    def paths_for(self, pks):
+        """Return {ID: path} of existing `pks` composed from slugs of their ancestors.
+
+        The stored `path` column is not used; slugs of ancestors which are not
+        cached yet are loaded by one query.
+        """
+        version = self._current_version()
+        chains = dict((pk, self.model.ancestor_ids_for(pk)) for pk in pks
+                      if self.model.is_valid_id(pk))
+        known = self._lookup(self.paths, set(pk for chain in chains.values() for pk in chain))
+        needed = set()
+        for chain in chains.values():
+            for pk in reversed(chain):
+                if pk in known:
+                    break
+                needed.add(pk)
+        slugs = dict(self._rows().filter(id__in=needed).values_list("id", "slug")) \
+            if needed else {}
+        result, pairs = {}, []
+        for pk, chain in chains.items():
+            path = None
+            for ancestor_id in chain:
+                if ancestor_id in known:
+                    path = known[ancestor_id]
+                    continue
+                if ancestor_id not in slugs:
+                    path = None
+                    break
+                path = "/".join((path, slugs[ancestor_id])) if path else slugs[ancestor_id]
+                known[ancestor_id] = path
+                pairs.append((path, ancestor_id))
+            if path is not None:
+                result[pk] = path
+        self._store(version, pairs)
+        return result
@@ -0,0 +1,86 @@
+#coding: utf-8
+"""Registry of foreign keys pointing to hierarchical models.
+
+Operations which renumber whole subtrees (e.g. `HierarchicalModel.move_to`)
+rewrite registered foreign keys with the same range arithmetic as the tree
+itself, so the related rows follow their categories::
+
+    # :file: models.py
+    from bitcategory import references
+
+    class MyProduct(models.Model):
+        category = models.ForeignKey(MyCategory)
+
+    references.register(MyProduct, "category")
+
+`HierarchicalModel.delete_subtree` handles all foreign keys to the tree by
+range statements following their `on_delete`. A registered reference can
+override it by `on_delete` (CASCADE, SET_NULL, PROTECT or DO_NOTHING)::
+
+    references.register(MyProduct, "category", on_delete=models.PROTECT)
+
+Foreign keys which are not registered would keep dangling IDs, so `move_to`
+and `bitcategory.defrag.compact` refuse to run while there are any unless
+told to ignore them (see `check_registered`).
+"""
+from django.db.models.deletion import get_candidate_relations_to_delete
+
+from bitcategory.compat import remote_model
+
+_registry = {}
+_policies = {}
+
+
+def register(model, field_name, on_delete=None):
+    """Register a foreign key `field_name` of `model` to a hierarchical model.
+
+    :param: `on_delete` policy used by `delete_subtree` instead of the field's own
+    """
+    field = model._meta.get_field(field_name)
+    target = remote_model(field)._meta.concrete_model
+    reference = (model, field.attname)
+    references = _registry.setdefault(target, [])
+    if reference not in references:
+        references.append(reference)
+    if on_delete is None:
+        _policies.pop(reference, None)
+    else:
+        _policies[reference] = on_delete
+
+
+def unregister(model, field_name):
+    """Remove previously registered foreign key."""
+    field = model._meta.get_field(field_name)
+    references = _registry.get(remote_model(field)._meta.concrete_model, [])
+    if (model, field.attname) in references:
+        references.remove((model, field.attname))
+    _policies.pop((model, field.attname), None)
+
+
+def references_to(model):
+    """Return list of (model, attname) referencing given hierarchical model."""
+    return list(_registry.get(model._meta.concrete_model, ()))
+
+
+def unregistered_references(model):
+    """Return list of (model, attname) of foreign keys to `model` which are not registered."""
+    registered = references_to(model)
+    return [(relation.related_model, relation.field.attname)
+            for relation in get_candidate_relations_to_delete(model._meta)
+            if relation.related_model is not model._meta.concrete_model and
+            (relation.related_model, relation.field.attname) not in registered]
+
+
+def check_registered(model):
+    """Raise `ValueError` unless all foreign keys to `model` are registered."""
+    unregistered = unregistered_references(model)
+    if unregistered:
+        raise ValueError("Foreign keys {0} are not registered in bitcategory.references, "
+                         "their rows would keep old IDs".format(", ".join(
+                             "{0}.{1}".format(ref_model._meta.label, attname)
+                             for ref_model, attname in unregistered)))
+
+
+def on_delete_for(model, attname):
+    """Return `on_delete` registered for the foreign key (None when not overridden)."""
+    return _policies.get((model, attname))
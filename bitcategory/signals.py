@@ -0,0 +1,14 @@
+#coding: utf-8
+"""Signals of tree-wide operations.
+
+`subtree_deleted` is sent once by `delete_subtree` instead of `pre_delete`
+and `post_delete` for every deleted node. `ranges` are the deleted [gte, lt)
+ID ranges, `count` the number of deleted nodes and `using` the database
+alias::
+
+    def receiver(sender, ranges, count, using, **kwargs):
+        ...
+"""
+from django.dispatch import Signal
+
+subtree_deleted = Signal()
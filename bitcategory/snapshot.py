@@ -0,0 +1,220 @@
+#coding: utf-8
+"""In-memory snapshot of a whole hierarchical table.
+
+The snapshot is meant for small, rarely changing trees (categories) which are
+read on every request. The table is loaded by one query into parallel arrays
+and every structural question is then answered without touching the DB::
+
+    snapshot = Category.tree_snapshot()
+    snapshot.ancestors(category)       # list of instances, root first
+    snapshot.descendant_ids(category)  # list of ids
+
+Rows are kept ordered by id. Since the id of a child always follows the id of
+its parent, the id order is a depth-first pre-order of the tree and a subtree
+is one contiguous slice of the arrays.
+"""
+from array import array
+from bisect import bisect_left
+import threading
+
+import six
+from django.db import router
+
+try:
+    ID_TYPECODE = array("q").typecode
+except ValueError:  # python 2 has no long long arrays
+    ID_TYPECODE = "l"
+
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def get_snapshot(model):
+    """Return up-to-date snapshot for the `model` (built lazily)."""
+    model = model._meta.concrete_model
+    # read the version before loading so a concurrent change forces a reload
+    version = model.tree_version()
+    snapshot = _snapshots.get(model)
+    if snapshot is None or snapshot.version != version:
+        with _lock:
+            snapshot = _snapshots.get(model)
+            if snapshot is None or snapshot.version != version:
+                snapshot = TreeSnapshot(model, version)
+                _snapshots[model] = snapshot
+    return snapshot
+
+
+def invalidate_snapshot(model):
+    """Drop the snapshot of `model` held by this process."""
+    _snapshots.pop(model._meta.concrete_model, None)
+
+
+class TreeSnapshot(object):
+    """
+    Read-only copy of a tree stored in compact parallel arrays.
+
+    Structural columns (id, parent, level) live in typed arrays together with
+    precomputed links (first child, next sibling, end of subtree). All the
+    other columns are kept as plain tuples. Model instances are created only
+    when asked for and they never hit the database.
+
+    Every method accepts either a model instance or an integer id and raises
+    `model.DoesNotExist` for ids which are not in the snapshot.
+    """
+    def __init__(self, model, version=None):
+        self.model = model
+        self.version = version
+        self.db = router.db_for_read(model)
+        self.fields = [field.attname for field in model._meta.concrete_fields]
+        columns = list(zip(*model._default_manager.using(self.db)
+                                 .order_by("id").values_list(*self.fields)))
+        if not columns:
+            columns = [()] * len(self.fields)
+        self.columns = dict(zip(self.fields, columns))
+
+        self.ids = array(ID_TYPECODE, self.columns["id"])
+        self.parent_ids = array(ID_TYPECODE, (pid or 0 for pid in self.columns["parent_id"]))
+        self.levels = array("H", self.columns["level"])
+        self._link()
+
+    def _link(self):
+        """Compute first child, next sibling and subtree end for every row."""
+        size = len(self.ids)
+        self.first_child_idx = array("i", [-1]) * size
+        self.next_sibling_idx = array("i", [-1]) * size
+        self.end_idx = array("i", [size]) * size
+        self.first_root_idx = -1
+        last_child = {}
+        stack = []
+        last_root = -1
+        for i in range(size):
+            parent_id = self.parent_ids[i]
+            while stack and self.ids[stack[-1]] != parent_id:
+                self.end_idx[stack.pop()] = i
+            if stack:
+                parent = stack[-1]
+                previous = last_child.get(parent, -1)
+                if previous < 0:
+                    self.first_child_idx[parent] = i
+                else:
+                    self.next_sibling_idx[previous] = i
+                last_child[parent] = i
+            else:
+                if last_root < 0:
+                    self.first_root_idx = i
+                else:
+                    self.next_sibling_idx[last_root] = i
+                last_root = i
+            stack.append(i)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, node):
+        pk = self._pk(node)
+        i = bisect_left(self.ids, pk)
+        return i < len(self.ids) and self.ids[i] == pk
+
+    def _pk(self, node):
+        return node if isinstance(node, six.integer_types) else node.pk
+
+    def _index(self, node):
+        pk = self._pk(node)
+        i = bisect_left(self.ids, pk)
+        if i == len(self.ids) or self.ids[i] != pk:
+            raise self.model.DoesNotExist(
+                "{0} with id {1} is not in the snapshot".format(self.model.__name__, pk))
+        return i
+
+    def _siblings(self, first):
+        i = first
+        while i >= 0:
+            yield i
+            i = self.next_sibling_idx[i]
+
+    def _ancestors(self, i):
+        chain = [i]
+        while self.parent_ids[i]:
+            i = self._index(self.parent_ids[i])
+            chain.append(i)
+        chain.reverse()
+        return chain
+
+    def _neighbours(self, i):
+        if self.parent_ids[i]:
+            return list(self._siblings(self.first_child_idx[self._index(self.parent_ids[i])]))
+        return list(self._siblings(self.first_root_idx))
+
+    def _instance(self, i):
+        values = [self.columns[field][i] for field in self.fields]
+        return self.model.from_db(self.db, self.fields, values)
+
+    def get(self, node):
+        """Return model instance for given id."""
+        return self._instance(self._index(node))
+
+    def value(self, node, field):
+        """Return value of a single `field` (attname) for given id."""
+        return self.columns[field][self._index(node)]
+
+    # ids
+    def ancestor_ids(self, node):
+        """All ancestor ids including itself ordered from the root."""
+        return [self.ids[i] for i in self._ancestors(self._index(node))]
+
+    def descendant_ids(self, node):
+        """All descendant ids including itself in id order."""
+        i = self._index(node)
+        return self.ids[i:self.end_idx[i]].tolist()
+
+    def neighbour_ids(self, node):
+        """All neighbour ids including itself."""
+        return [self.ids[i] for i in self._neighbours(self._index(node))]
+
+    def children_ids(self, node):
+        """Ids of direct children."""
+        return [self.ids[i] for i in self._siblings(self.first_child_idx[self._index(node)])]
+
+    def root_ids(self):
+        """Ids of all the roots."""
+        return [self.ids[i] for i in self._siblings(self.first_root_idx)]
+
+    def first_child_id(self, node):
+        """Id of the first child or None."""
+        i = self.first_child_idx[self._index(node)]
+        return self.ids[i] if i >= 0 else None
+
+    def root_id(self, node):
+        """Id of the root of given node."""
+        return self.ids[self._ancestors(self._index(node))[0]]
+
+    # instances
+    def ancestors(self, node):
+        """All ancestors including itself ordered from the root."""
+        return [self._instance(i) for i in self._ancestors(self._index(node))]
+
+    def descendants(self, node):
+        """All descendants including itself in id order."""
+        i = self._index(node)
+        return [self._instance(j) for j in range(i, self.end_idx[i])]
+
+    def neighbours(self, node):
+        """All neighbours including itself."""
+        return [self._instance(i) for i in self._neighbours(self._index(node))]
+
+    def children(self, node):
+        """Direct children."""
+        return [self._instance(i) for i in self._siblings(self.first_child_idx[self._index(node)])]
+
+    def roots(self):
+        """All the roots."""
+        return [self._instance(i) for i in self._siblings(self.first_root_idx)]
+
+    def first_child(self, node):
+        """First child or None."""
+        i = self.first_child_idx[self._index(node)]
+        return self._instance(i) if i >= 0 else None
+
+    def root(self, node):
+        """Root of given node."""
+        return self._instance(self._ancestors(self._index(node))[0])
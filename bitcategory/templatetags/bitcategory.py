@@ -0,0 +1,98 @@
+#coding: utf-8
+"""Category menus and breadcrumbs::
+
+    {% load bitcategory %}
+    {% category_menu category depth=3 %}
+    {% category_breadcrumb category %}
+    {% category_tree "myapp.MyCategory" depth=2 %}
+
+Every fragment is built from one query and cached (``BITCATEGORY_CACHE``) under
+a key containing the tree version, so all processes share it until the tree
+changes. Cached fragments expire after ``BITCATEGORY_FRAGMENT_TIMEOUT`` seconds
+(a day by default). The markup comes from templates ``bitcategory/menu.html``
+and ``bitcategory/breadcrumb.html`` which can be overridden or replaced by
+the `template` argument.
+"""
+from __future__ import absolute_import
+
+import hashlib
+
+from django import template
+from django.apps import apps
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.encoding import force_bytes
+from django.utils.safestring import mark_safe
+
+from bitcategory.models import get_cache
+
+register = template.Library()
+
+
+def _cached(model, parts, render):
+    """Return fragment for `parts` from the cache or render and store it."""
+    key = "{0}:fragment:{1}:{2}".format(model._version_key(), model.tree_version(),
+                                        hashlib.md5(force_bytes(repr(parts))).hexdigest())
+    cache = get_cache()
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = render()
+        cache.set(key, fragment, getattr(settings, "BITCATEGORY_FRAGMENT_TIMEOUT", 86400))
+    return mark_safe(fragment)
+
+
+def _nest(nodes, top_level):
+    """Turn nodes in ID order into nested [{"node": node, "children": [...]}, ...]."""
+    items, stack = [], {}
+    for node in nodes:
+        item = {"node": node, "children": []}
+        if node.level == top_level:
+            items.append(item)
+        elif node.parent_id in stack:
+            stack[node.parent_id]["children"].append(item)
+        stack[node.pk] = item
+    return items
+
+
+def _render_menu(nodes, top_level, template_name):
+    return render_to_string(template_name, {"items": _nest(nodes, top_level),
+                                            "template": template_name})
+
+
+@register.simple_tag
+def category_menu(root, depth=1, template="bitcategory/menu.html"):
+    """Nested list of descendants of `root` down to `depth` levels below it."""
+    if root is None:
+        return ""
+    model = root.__class__
+
+    def render():
+        nodes = [node for node in root.iter_dfs(max_depth=depth) if node.pk != root.pk]
+        return _render_menu(nodes, root.level + 1, template)
+    return _cached(model, ("menu", root.pk, depth, template), render)
+
+
+@register.simple_tag
+def category_tree(model, depth=None, template="bitcategory/menu.html"):
+    """Nested list of the whole tree (or its `depth` top levels) of `model` ("app.Model")."""
+    if not hasattr(model, "_meta"):
+        model = apps.get_model(model)
+
+    def render():
+        nodes = model.objects.order_by("id")
+        if depth is not None:
+            nodes = nodes.filter(level__lte=depth)
+        return _render_menu(nodes.iterator(), 1, template)
+    return _cached(model, ("tree", depth, template), render)
+
+
+@register.simple_tag
+def category_breadcrumb(category, template="bitcategory/breadcrumb.html"):
+    """List of ancestors of `category` from the root (including itself)."""
+    if category is None:
+        return ""
+    model = category.__class__
+
+    def render():
+        return render_to_string(template, {"ancestors": list(category.ancestors)})
+    return _cached(model, ("breadcrumb", category.pk, template), render)
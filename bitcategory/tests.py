@@ -1,7 +1,27 @@
 from __future__ import absolute_import
-from django.test import TestCase
+import json
+import re
+import threading
+import unittest
+import zlib
 
-from .models import Category
+import six
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from six import StringIO
+
+from .fields import HierarchicalField
+from .instrumentation import get_backend
+from .layout import BitLayout
+from .lookups import coalesce_ranges
+from .models import Category, HierarchicalModel, LevelFullError, free_slots
+from .vectorized import np
+from .views import ajax, tree
+from .widgets import HierarchicalSelect
+from . import vectorized
 
 
 class UnitTests(TestCase):
@@ -96,6 +116,20 @@ class ModelTest(TestCase):
         self.assertFalse(hm1 > hm2)
         self.assertFalse(hm11 > hm1)
 
+    def test_structure_from_id(self):
+        root = Category.objects.create(name="root")
+        child = Category.objects.create(name="child", parent=root)
+        grandchild = Category.objects.create(name="grandchild", parent=child)
+        lazy = Category.lazy_instance(grandchild.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(lazy.ancestor_ids, [root.pk, child.pk, grandchild.pk])
+            self.assertEqual(lazy.root_id, root.pk)
+            self.assertEqual(lazy.parent_id_from_bits, child.pk)
+            self.assertEqual(lazy.slot_index, 1)
+            self.assertEqual(Category.parent_id_for(child.pk), root.pk)
+            self.assertIsNone(root.parent_id_from_bits)
+            self.assertIs(root.root, root)
+
     def test_contains(self):
         hm1 = Category(parent=None, level=1, name="cat1")
         hm1.save()
@@ -147,3 +181,686 @@ class ModelTest(TestCase):
 
         self.assertEqual(cat221.neighbours.count(), 2)
         self.assertEqual(cat222.neighbours.count(), 2)
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        self.cat1 = Category.objects.create(parent=None, name="cat1")
+        self.cat2 = Category.objects.create(parent=None, name="cat2")
+        self.cat21 = Category.objects.create(parent=self.cat2, name="cat21")
+        self.cat22 = Category.objects.create(parent=self.cat2, name="cat22")
+        self.cat221 = Category.objects.create(parent=self.cat22, name="cat221")
+        self.cat23 = Category.objects.create(parent=self.cat2, name="cat23")
+
+    def test_structure(self):
+        Category.tree_snapshot()
+        ancestor_ids = list(self.cat221.ancestors.order_by("id").values_list("id", flat=True))
+        with self.assertNumQueries(0):
+            snapshot = Category.tree_snapshot()
+            self.assertEqual(len(snapshot), 6)
+            self.assertEqual(snapshot.root_ids(), [self.cat1.id, self.cat2.id])
+            self.assertEqual(snapshot.ancestor_ids(self.cat221), ancestor_ids)
+            self.assertEqual(snapshot.descendant_ids(self.cat2),
+                             [self.cat2.id, self.cat21.id, self.cat22.id, self.cat221.id, self.cat23.id])
+            self.assertEqual(snapshot.neighbour_ids(self.cat22.id),
+                             [self.cat21.id, self.cat22.id, self.cat23.id])
+            self.assertEqual(snapshot.neighbour_ids(self.cat1), [self.cat1.id, self.cat2.id])
+            self.assertEqual(snapshot.children_ids(self.cat22), [self.cat221.id])
+            self.assertEqual(snapshot.first_child(self.cat2), self.cat21)
+            self.assertIsNone(snapshot.first_child_id(self.cat1))
+            self.assertEqual(snapshot.root(self.cat221), self.cat2)
+            self.assertEqual([c.name for c in snapshot.ancestors(self.cat221)],
+                             ["cat2", "cat22", "cat221"])
+            self.assertTrue(self.cat21 in snapshot)
+            self.assertRaises(Category.DoesNotExist, snapshot.get, 1)
+
+    def test_invalidation(self):
+        snapshot = Category.tree_snapshot()
+        self.assertEqual(snapshot.children_ids(self.cat1), [])
+        cat11 = Category.objects.create(parent=self.cat1, name="cat11")
+        self.assertEqual(Category.tree_snapshot().children_ids(self.cat1), [cat11.id])
+        self.cat21.delete()
+        self.assertNotIn(self.cat21.id, Category.tree_snapshot().descendant_ids(self.cat2))
+        version = Category.tree_version()
+        Category.bump_tree_version()
+        self.assertNotEqual(Category.tree_snapshot().version, version)
+
+
+class SubtreeTest(TestCase):
+
+    def setUp(self):
+        self.root = Category.objects.create(name="root")
+        self.a = Category.objects.create(name="a", parent=self.root)
+        self.b = Category.objects.create(name="b", parent=self.root)
+        self.a1 = Category.objects.create(name="a1", parent=self.a)
+        self.a11 = Category.objects.create(name="a11", parent=self.a1)
+        self.b1 = Category.objects.create(name="b1", parent=self.b)
+
+    def test_load_subtree(self):
+        with self.assertNumQueries(1):
+            root = self.root.load_subtree()
+            self.assertEqual([c.name for c in root.children.all()], ["a", "b"])
+            a = root.children.all()[0]
+            self.assertEqual([c.name for c in a.children.all()], ["a1"])
+            self.assertEqual(a.children.all()[0].children.all()[0].name, "a11")
+            self.assertIs(a.parent, root)
+        root = Category.objects.get(pk=self.root.pk).load_subtree(max_depth=1)
+        with self.assertNumQueries(0):
+            b = root.children.all()[1]
+        # children below max_depth are not loaded and have to be queried
+        with self.assertNumQueries(1):
+            self.assertEqual(len(b.children.all()), 1)
+
+    def test_traversal(self):
+        with self.assertNumQueries(1):
+            self.assertEqual([c.name for c in self.root.iter_dfs()],
+                             ["root", "a", "a1", "a11", "b", "b1"])
+        self.assertEqual([c.name for c in self.root.iter_bfs()],
+                         ["root", "a", "b", "a1", "b1", "a11"])
+        self.assertEqual([(c.name, depth) for c, depth in self.a.walk(max_depth=1)],
+                         [("a", 0), ("a1", 1)])
+
+
+class AllocatorTest(TestCase):
+
+    def test_free_slots(self):
+        self.assertEqual(free_slots(0, 32), [1])
+        self.assertEqual(free_slots(0b10110, 32, 3), [3, 5, 6])
+        self.assertEqual(free_slots((1 << 32) - 2, 32), [])
+
+    def test_get_free_ids(self):
+        cat1 = Category.objects.create(parent=None, name="cat1")
+        cat11 = Category.objects.create(parent=cat1, name="cat11")
+        cat12 = Category.objects.create(parent=cat1, name="cat12")
+        cat13 = Category.objects.create(parent=cat1, name="cat13")
+        step = cat11.min
+        new = Category(parent=cat1, level=2, name="new")
+        # fast path without gaps
+        with self.assertNumQueries(1):
+            self.assertEqual(new.get_free_ids(2), [cat13.id + step, cat13.id + 2 * step])
+        cat12_id = cat12.id
+        cat12.delete()
+        self.assertEqual(new.get_free_ids(3), [cat12_id, cat13.id + step, cat13.id + 2 * step])
+
+    def test_level_full(self):
+        step = 1 << 27
+        Category.objects.bulk_create(
+            Category(id=slot * step, name="root{0}".format(slot), path="root{0}".format(slot))
+            for slot in range(1, 32))
+        new = Category(parent=None, level=1, name="new")
+        self.assertRaises(LevelFullError, new.get_free_id)
+        Category.objects.filter(id=7 * step).delete()
+        self.assertEqual(new.get_free_id(), 7 * step)
+        self.assertRaises(LevelFullError, new.get_free_ids, 2)
+
+
+class ReservationTest(TestCase):
+
+    def test_reserve_ids(self):
+        root = Category.objects.create(name="root")
+        first = Category.objects.create(name="first", parent=root)
+        ids = Category(parent=root).reserve_ids(2)
+        self.assertEqual(ids, [first.id + first.min, first.id + 2 * first.min])
+        second = Category.objects.create(name="second", parent=root)
+        self.assertEqual(second.id, first.id + 3 * first.min)
+        Category.objects.bulk_create([Category(id=pk, parent=root, level=2, name=str(pk), path=str(pk))
+                                      for pk in ids])
+        Category.release_ids(ids)
+        self.assertEqual(Category.objects.filter(parent=root).count(), 4)
+
+    def test_retry_taken_id(self):
+        root = Category.objects.create(name="root")
+        taken = Category.objects.create(name="taken", parent=root)
+        node = Category(name="node", parent=root)
+        stale = [[taken.id]]
+
+        def reserve_ids(count):
+            return stale.pop() if stale else Category.reserve_ids(node, count)
+        node.reserve_ids = reserve_ids
+        node.save()
+        self.assertEqual(node.id, taken.id + taken.min)
+
+
+class ConcurrentSaveTest(TransactionTestCase):
+
+    def test_threads(self):
+        root = Category.objects.create(name="root")
+        errors = []
+
+        def insert(thread):
+            try:
+                for i in range(3):
+                    Category.objects.create(name="{0}-{1}".format(thread, i), parent=root)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connections.close_all()
+        threads = [threading.Thread(target=insert, args=(n, )) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Category.objects.filter(parent=root).count(), 24)
+
+
+class CommitVersionTest(TransactionTestCase):
+
+    def test_snapshot_during_transaction(self):
+        root = Category.objects.create(name="root")
+
+        def read():
+            try:
+                Category.tree_snapshot()  # sees the tree before the commit
+            finally:
+                connections.close_all()
+        with transaction.atomic():
+            child = Category.objects.create(name="child", parent=root)
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join()
+        self.assertEqual(Category.tree_snapshot().children_ids(root), [child.id])
+
+    def test_cached_responses_during_transaction(self):
+        root = Category.objects.create(name="root")
+        menu = Template("{% load bitcategory %}{% category_menu root %}")
+        factory = RequestFactory()
+        etags = []
+
+        def read():
+            try:
+                menu.render(Context({"root": root}))
+                b"".join(tree(factory.get("/"), model=Category))
+                etags.append(ajax(factory.get("/", {"id": root.pk}), model=Category)["ETag"])
+            finally:
+                connections.close_all()
+        with transaction.atomic():
+            Category.objects.create(name="child", parent=root)
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join()
+        self.assertIn(">child<", menu.render(Context({"root": root})))
+        self.assertIn(b"child", b"".join(tree(factory.get("/"), model=Category)))
+        response = ajax(factory.get("/", {"id": root.pk}, HTTP_IF_NONE_MATCH=etags[0]),
+                        model=Category)
+        self.assertEqual(response.status_code, 200)
+
+
+class BulkCreateTreeTest(TestCase):
+
+    def test_bulk_create_tree(self):
+        existing = Category.objects.create(parent=None, name="existing")
+        with self.assertNumQueries(6):  # free slots, savepoint, 3 batches, release
+            created = Category.objects.bulk_create_tree([
+                {"name": "Books", "children": [
+                    ("Fiction", "fic", ["Fantasy", "Sci-fi"]),
+                    "Poetry",
+                ]},
+                ("Music", None),
+            ], batch_size=2)
+        self.assertEqual(len(created), 6)
+        self.assertEqual(Category.objects.count(), 7)
+        books = Category.objects.get(name="Books")
+        music = Category.objects.get(name="Music")
+        self.assertEqual(books.id, existing.id + existing.min)
+        self.assertEqual(music.id, books.id + books.min)
+        fantasy = Category.objects.get(name="Fantasy")
+        self.assertEqual(fantasy.path, "books/fic/fantasy")
+        self.assertEqual(fantasy.level, 3)
+        self.assertEqual(fantasy.parent.name, "Fiction")
+        self.assertTrue(fantasy in books)
+        self.assertEqual(books.descendants.count(), 5)
+        self.assertEqual([c.name for c in created],
+                         ["Books", "Fiction", "Fantasy", "Sci-fi", "Poetry", "Music"])
+
+    def test_under_parent(self):
+        root = Category.objects.create(parent=None, name="root")
+        child1 = Category.objects.create(parent=root, name="child1")
+        child2 = Category.objects.create(parent=root, name="child2")
+        child1_id = child1.id
+        child1.delete()
+        Category.objects.bulk_create_tree(["a", "b"], parent=root)
+        self.assertEqual(Category.objects.get(name="a").id, child1_id)
+        self.assertEqual(Category.objects.get(name="b").id, child2.id + child2.min)
+        self.assertEqual(Category.objects.get(name="b").path, "root/b")
+        self.assertEqual(Category.tree_snapshot().children_ids(root), [child1_id, child2.id, child2.id + child2.min])
+        self.assertRaises(LevelFullError, Category.objects.bulk_create_tree,
+                          [("big", None, ["x"] * 32)])
+
+
+class PathTest(TestCase):
+
+    def setUp(self):
+        self.books = Category.objects.create(parent=None, name="books")
+        self.fiction = Category.objects.create(parent=self.books, name="fiction")
+        self.fantasy = Category.objects.create(parent=self.fiction, name="fantasy")
+        self.music = Category.objects.create(parent=None, name="music")
+
+    def test_rename_propagates(self):
+        self.books.slug = "literature"
+        self.books.save()
+        self.assertEqual(Category.objects.get(name="books").path, "literature")
+        self.assertEqual(Category.objects.get(name="fiction").path, "literature/fiction")
+        self.assertEqual(Category.objects.get(name="fantasy").path, "literature/fiction/fantasy")
+        self.assertEqual(Category.objects.get(name="music").path, "music")
+        fiction = Category.objects.get(name="fiction")
+        fiction.slug = "novels"
+        fiction.save()
+        self.assertEqual(Category.objects.get(name="fantasy").path, "literature/novels/fantasy")
+
+    def test_rebuild_paths(self):
+        for category in Category.objects.exclude(name="books"):
+            Category.objects.filter(id=category.id).update(path="broken-" + category.name)
+        self.assertEqual(Category.rebuild_paths(batch_size=1), 3)
+        self.assertEqual(Category.objects.get(name="fantasy").path, "books/fiction/fantasy")
+        self.assertEqual(Category.objects.get(name="music").path, "music")
+        self.assertEqual(Category.rebuild_paths(), 0)
+
+    def test_resolve_paths(self):
+        paths = ["books", "/books/fiction/", "books/fiction/fantasy", "nothing"]
+        with self.assertNumQueries(1):
+            resolved = Category.resolve_paths(paths)
+        self.assertEqual(resolved, {"books": self.books.id, "books/fiction": self.fiction.id,
+                                    "books/fiction/fantasy": self.fantasy.id})
+        with self.assertNumQueries(0):
+            self.assertEqual(Category.resolve_paths(paths), resolved)
+            self.assertEqual(Category.resolve_path("books/fiction"), self.fiction.id)
+            self.assertIsNone(Category.resolve_path("nothing"))
+        self.books.slug = "literature"
+        self.books.save()
+        self.assertIsNone(Category.resolve_path("books/fiction"))
+        self.assertEqual(Category.resolve_path("literature/fiction"), self.fiction.id)
+
+    def test_paths_for(self):
+        Category.objects.filter(id=self.fantasy.id).update(path="stale")
+        with self.assertNumQueries(1):
+            paths = Category.paths_for([self.fantasy.id, self.music.id, self.music.id + 1, 0])
+        self.assertEqual(paths, {self.fantasy.id: "books/fiction/fantasy", self.music.id: "music"})
+        with self.assertNumQueries(0):
+            self.assertEqual(Category.paths_for([self.fiction.id]),
+                             {self.fiction.id: "books/fiction"})
+            self.assertEqual(Category.resolve_path("books/fiction/fantasy"), self.fantasy.id)
+
+
+class LookupUnitTest(TestCase):
+
+    def test_coalesce_ranges(self):
+        self.assertEqual(coalesce_ranges([]), [])
+        self.assertEqual(coalesce_ranges([(10, 20), (0, 5), (12, 15), (20, 30), (31, 40)]),
+                         [(0, 5), (10, 30), (31, 40)])
+
+    def test_bits_from_id(self):
+        root = 0b00011000000000000000000000000000
+        child = 0b00011001010000000000000000000000
+        self.assertEqual(Category.level_from_id(root), 1)
+        self.assertEqual(Category.level_from_id(child), 2)
+        self.assertEqual(Category.bounds_for(child), (child, child + (1 << 22)))
+        self.assertEqual(Category.ancestor_ids_for(child), [root, child])
+
+
+class WidgetTest(TestCase):
+
+    def setUp(self):
+        self.cat1 = Category.objects.create(parent=None, name="cat1")
+        self.cat2 = Category.objects.create(parent=None, name="cat2")
+        self.cat21 = Category.objects.create(parent=self.cat2, name="cat21")
+        self.cat22 = Category.objects.create(parent=self.cat2, name="cat22")
+        self.cat221 = Category.objects.create(parent=self.cat22, name="cat221")
+        self.widget = HierarchicalSelect()
+        self.widget.model = Category
+        self.widget.url = "/ajax"
+
+    def test_levels(self):
+        with self.assertNumQueries(1):
+            levels = self.widget.levels(self.cat22)
+        self.assertEqual(levels, [
+            (1, [(self.cat1.id, "cat1"), (self.cat2.id, "cat2")], self.cat2.id),
+            (2, [(self.cat21.id, "cat21"), (self.cat22.id, "cat22")], self.cat22.id),
+            (3, [(self.cat221.id, "cat221")], None),
+        ])
+        self.assertEqual(len(self.widget.levels(self.cat221)), 3)
+        self.assertEqual(len(self.widget.levels(str(self.cat21.id))), 2)
+        self.assertEqual(self.widget.levels(None), [
+            (1, [(self.cat1.id, "cat1"), (self.cat2.id, "cat2")], None)])
+
+    def test_render(self):
+        with self.assertNumQueries(1):
+            html = self.widget.render("category", self.cat22.id, {"id": "id_category"})
+        self.assertEqual(html.count("<select"), 3)
+        self.assertIn('name="category_3"', html)
+        self.assertIn('<option value="{0}" selected="selected">cat22</option>'.format(self.cat22.id), html)
+
+    def test_shared_cache(self):
+        cache = {}
+        widgets = [HierarchicalSelect(choice_cache=cache) for i in range(3)]
+        for widget in widgets:
+            widget.model = Category
+        with self.assertNumQueries(1):
+            for widget in widgets:
+                widget.render("category", self.cat221.id, {"id": "id_category"})
+
+
+class AjaxViewTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.cat1 = Category.objects.create(parent=None, name="cat1")
+        self.cat11 = Category.objects.create(parent=self.cat1, name="cat11")
+        self.cat111 = Category.objects.create(parent=self.cat11, name="cat111")
+        self.cat2 = Category.objects.create(parent=None, name="cat2")
+        self.cat21 = Category.objects.create(parent=self.cat2, name="cat21")
+
+    def get(self, data, **headers):
+        return ajax(self.factory.get("/hierarchical_ajax", data, **headers), model=Category)
+
+    def test_single_level(self):
+        with self.assertNumQueries(1):
+            response = self.get({"id": self.cat1.id, "caller": "id_category_1"})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(data, {"caller": "id_category_1", "level": 2,
+                                "items": [[self.cat11.id, "cat11"]]})
+        self.assertIn("no-cache", response["Cache-Control"])
+        self.assertEqual(self.get({"id": 1}).status_code, 400)
+        self.assertEqual(self.get({"id": "x"}).status_code, 400)
+        self.assertEqual(self.get({}).status_code, 400)
+
+    def test_conditional(self):
+        response = self.get({"id": self.cat1.id})
+        with self.assertNumQueries(0):
+            cached = self.get({"id": self.cat1.id}, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(cached.status_code, 304)
+        self.cat11.name = "renamed"
+        self.cat11.save()
+        changed = self.get({"id": self.cat1.id}, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed["ETag"], response["ETag"])
+
+    def test_batched(self):
+        response = self.get({"id": [self.cat1.id, self.cat2.id], "depth": 2})
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(data["items"], [[self.cat11.id, "cat11"]])
+        self.assertEqual(data["children"], {
+            str(self.cat1.id): [[self.cat11.id, "cat11"]],
+            str(self.cat11.id): [[self.cat111.id, "cat111"]],
+            str(self.cat2.id): [[self.cat21.id, "cat21"]],
+        })
+
+    def test_depth(self):
+        response = self.get({"id": self.cat1.id, "depth": 10 ** 9})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf-8"))["children"], {
+            str(self.cat1.id): [[self.cat11.id, "cat11"]],
+            str(self.cat11.id): [[self.cat111.id, "cat111"]],
+        })
+        self.assertEqual(self.get({"id": self.cat1.id, "depth": 0}).status_code, 400)
+        self.assertEqual(self.get({"id": self.cat1.id, "depth": -1}).status_code, 400)
+        self.assertEqual(self.get({"id": self.cat1.id, "depth": "x"}).status_code, 400)
+
+
+class TreeViewTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.cat1 = Category.objects.create(parent=None, name="cat1")
+        self.cat11 = Category.objects.create(parent=self.cat1, name="cat11")
+        self.cat2 = Category.objects.create(parent=None, name="cat2")
+
+    def get(self, **headers):
+        response = tree(self.factory.get("/hierarchical_tree", **headers), model=Category)
+        content = b"".join(response) if response.streaming else response.content
+        if response.has_header("Content-Encoding"):
+            content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        return response, json.loads(content.decode("utf-8"))
+
+    def test_payload(self):
+        response, data = self.get()
+        self.assertTrue(response.streaming)
+        self.assertEqual(data["id_bits"], 32)
+        self.assertEqual(data["nodes"], [
+            [self.cat1.id, "cat1"], [self.cat11.id - self.cat1.id, "cat11"],
+            [self.cat2.id - self.cat11.id, "cat2"]])
+        with self.assertNumQueries(0):
+            cached, cached_data = self.get()
+        self.assertFalse(cached.streaming)
+        self.assertEqual(cached_data, data)
+        Category.objects.create(parent=self.cat2, name="cat21")
+        self.assertEqual(len(self.get()[1]["nodes"]), 4)
+
+    def test_gzip(self):
+        plain = self.get()[1]
+        response, data = self.get(HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(data, plain)
+        response, data = self.get(HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(response.streaming)
+        self.assertEqual(data, plain)
+
+
+class FieldTest(TestCase):
+
+    def setUp(self):
+        self.cat1 = Category.objects.create(parent=None, name="cat1")
+        self.cat11 = Category.objects.create(parent=self.cat1, name="cat11")
+        self.cat2 = Category.objects.create(parent=None, name="cat2")
+
+    def test_valid_id(self):
+        self.assertTrue(Category.is_valid_id(self.cat11.id))
+        self.assertFalse(Category.is_valid_id(0))
+        self.assertFalse(Category.is_valid_id(3))  # below the last level
+        self.assertFalse(Category.is_valid_id(1 << 22))  # empty root slot
+        self.assertFalse(Category.is_valid_id(1 << 32))
+
+    def test_structural_validation(self):
+        field = HierarchicalField(queryset=Category.objects.all(), subtree=self.cat1)
+        with self.assertNumQueries(0):
+            self.assertRaises(ValidationError, field.clean, "abc")
+            self.assertRaises(ValidationError, field.clean, 1 << 22)
+            self.assertRaises(ValidationError, field.clean, self.cat2.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(field.clean(str(self.cat11.id)).name, "cat11")
+
+    def test_lazy(self):
+        field = HierarchicalField(queryset=Category.objects.all(), lazy=True)
+        with self.assertNumQueries(1):
+            value = field.clean(self.cat11.id)
+        self.assertRaises(ValidationError, field.clean, self.cat11.id + self.cat11.min)
+        self.assertEqual(value.pk, self.cat11.id)
+        self.assertEqual(value.name, "cat11")
+        field = HierarchicalField(queryset=Category.objects.all(), lazy=True, use_snapshot=True)
+        field.clean(self.cat1.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(field.clean(self.cat2.id), self.cat2)
+
+
+class LayoutTest(TestCase):
+
+    def test_uniform(self):
+        layout = BitLayout.uniform(5, 32)
+        self.assertEqual(layout.depth, 6)
+        self.assertEqual(layout, Category.bit_layout())
+        self.assertEqual(layout.masks[2], 0b11111111110000000000000000000000)
+        self.assertEqual(layout.level_of(0b00001000010000000000000000000000), 2)
+        self.assertEqual(layout.level_of(0b11), 7)
+        self.assertFalse(layout.is_valid(0b11))
+
+    def test_custom(self):
+        layout = BitLayout([2, 3, 1], id_bits=8)
+        self.assertEqual(layout.right_offsets, (8, 6, 3, 2))
+        self.assertEqual(layout.steps, (256, 64, 8, 4))
+        self.assertEqual(layout.ancestors(0b01101100), [0b01000000, 0b01101000, 0b01101100])
+        self.assertEqual(layout.bounds(0b01101000), (0b01101000, 0b01110000))
+        self.assertEqual(layout.slot(0b01101100, 2), 0b101)
+        self.assertTrue(layout.is_valid(0b01001100))
+        self.assertFalse(layout.is_valid(0b00000100))
+        self.assertFalse(layout.is_valid(0b01000001))
+        self.assertRaises(ValueError, BitLayout, [40, 30], 63)
+        self.assertRaises(ValueError, BitLayout, [8] * 8, 64)
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class VectorizedTest(TestCase):
+
+    def setUp(self):
+        self.layout = BitLayout([2, 3, 1], id_bits=8)
+        self.ids = [pk for pk in range(1, 256) if self.layout.is_valid(pk)]
+
+    def test_levels_and_parents(self):
+        layout = self.layout
+        self.assertEqual(vectorized.levels(layout, self.ids).tolist(),
+                         [layout.level_of(pk) for pk in self.ids])
+        self.assertEqual(vectorized.parent_ids(layout, self.ids).tolist(),
+                         [([0] + layout.ancestors(pk))[-2] for pk in self.ids])
+        self.assertEqual(vectorized.levels(Category, [1 << 27, 0b11]).tolist(), [1, 7])
+        self.assertRaises(ValueError, vectorized.levels, layout, [0, 1])
+        self.assertRaises(ValueError, vectorized.parent_ids, layout, [0b11])
+
+    def test_ancestors(self):
+        layout = self.layout
+        for level in (1, 2, 3):
+            expected = [dict(enumerate(layout.ancestors(pk), 1)).get(level, 0) for pk in self.ids]
+            self.assertEqual(vectorized.ancestors_at(layout, self.ids, level).tolist(), expected)
+        ancestors, index = vectorized.bucket_by_ancestor(layout, self.ids, 1)
+        self.assertEqual(ancestors.tolist(), [0b01000000, 0b10000000, 0b11000000])
+        self.assertEqual(np.bincount(index).tolist(), [len(self.ids) // 3] * 3)
+
+    def test_in_subtrees(self):
+        layout = self.layout
+        nodes = [0b01101000, 0b01101100, 0b11000000]
+        bounds = [layout.bounds(pk) for pk in nodes]
+        self.assertEqual(vectorized.in_subtrees(layout, self.ids, nodes).tolist(),
+                         [any(gte <= pk < lt for gte, lt in bounds) for pk in self.ids])
+        self.assertEqual(vectorized.in_subtrees(layout, self.ids, 0b01101000).sum(), 2)
+        self.assertFalse(vectorized.in_subtrees(layout, self.ids, []).any())
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.root = Category.objects.create(name="root")
+        self.child = Category.objects.create(name="child", parent=self.root)
+
+    def test_disabled(self):
+        self.assertIsNone(get_backend())
+
+    @override_settings(BITCATEGORY_STATS_BACKEND="bitcategory.instrumentation.MemoryBackend")
+    def test_memory(self):
+        self.assertFalse(connection.queries_logged)  # counted without DEBUG
+        Category.objects.create(name="other", parent=self.root)
+        self.child.full_name()
+        self.child.root
+        stats = get_backend().stats()
+        self.assertEqual(stats["HierarchicalModel.save"]["calls"], 1)
+        self.assertEqual(stats["HierarchicalModel.get_free_ids"]["queries"], 1)
+        self.assertEqual(stats["CategoryBase.full_name"]["queries"], 1)
+        self.assertIsNone(stats["HierarchicalModel.ancestors"]["queries"])  # lazy queryset
+        self.assertEqual(stats["HierarchicalModel.root"]["queries"], 1)
+
+    @override_settings(BITCATEGORY_STATS_BACKEND="bitcategory.instrumentation.CacheBackend")
+    def test_command(self):
+        get_backend().reset()
+        widget = HierarchicalSelect()
+        widget.model = Category
+        widget.render("category", self.child.pk, {"id": "id_category"})
+        ajax(RequestFactory().get("/", {"id": self.root.pk}), model=Category)
+        output = StringIO()
+        call_command("bitcategory_stats", json=True, reset=True, stdout=output)
+        stats = json.loads(output.getvalue())
+        self.assertEqual(stats["HierarchicalSelect.render"]["calls"], 1)
+        self.assertEqual(stats["views.ajax"]["calls"], 1)
+        self.assertEqual(stats["views.ajax"]["queries"], 1)
+        self.assertEqual(get_backend().stats(), {})
+
+
+class TemplateTagTest(TestCase):
+
+    def setUp(self):
+        self.root = Category.objects.create(name="root")
+        self.a = Category.objects.create(name="a", parent=self.root)
+        self.a1 = Category.objects.create(name="a1", parent=self.a)
+        self.a11 = Category.objects.create(name="a11", parent=self.a1)
+        self.b = Category.objects.create(name="b", parent=self.root)
+
+    def render(self, source, **context):
+        return Template("{% load bitcategory %}" + source).render(Context(context))
+
+    def test_menu(self):
+        source = "{% category_menu root depth=2 %}"
+        with self.assertNumQueries(1):
+            html = self.render(source, root=self.root)
+        self.assertEqual(html.count("<ul"), 2)
+        self.assertTrue(html.index(">a<") < html.index(">a1<") < html.index(">b<"))
+        self.assertNotIn("a11", html)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render(source, root=self.root), html)
+        Category.objects.create(name="c", parent=self.root)
+        self.assertIn(">c<", self.render(source, root=self.root))
+
+    def test_tree_and_breadcrumb(self):
+        html = self.render('{% category_tree "bitcategory.Category" %}')
+        self.assertEqual(html.count("<ul"), 4)
+        with self.assertNumQueries(1):
+            html = self.render("{% category_breadcrumb category %}", category=self.a11)
+        self.assertEqual(re.findall(r'data-id="\d+">([^<]+)<', html), ["root", "a", "a1", "a11"])
+
+
+@unittest.skipIf(six.PY2, "async needs Python 3")
+class AsyncTest(TransactionTestCase):
+    """Queries run in a worker thread with its own connection, so the data are committed."""
+
+    def setUp(self):
+        self.root = Category.objects.create(name="root")
+        self.child = Category.objects.create(name="child", parent=self.root)
+
+    def run_async(self, coroutine):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_model(self):
+        self.assertEqual(self.run_async(self.child.aancestors()), [self.root, self.child])
+        self.assertEqual(self.run_async(self.root.adescendants()), [self.root, self.child])
+        self.assertEqual(self.run_async(self.child.aroot()), self.root)
+        node = Category(name="node", parent=self.root)
+        self.assertEqual(self.run_async(node.aget_free_id()), node.get_free_id())
+        self.run_async(node.asave())
+        self.assertEqual(node.parent_id_from_bits, self.root.pk)
+
+    def test_ajax(self):
+        from .async_views import ajax as async_ajax
+        request = RequestFactory().get("/", {"id": self.root.pk, "caller": "x"})
+        expected = ajax(request, model=Category)
+        response = self.run_async(async_ajax(request, model=Category))
+        self.assertEqual(json.loads(response.content.decode()), json.loads(expected.content.decode()))
+        self.assertEqual(response["ETag"], expected["ETag"])
+        request = RequestFactory().get("/", {"id": self.root.pk}, HTTP_IF_NONE_MATCH=expected["ETag"])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.run_async(async_ajax(request, model=Category)).status_code, 304)
+
+    def test_ajax_version_in_thread(self):
+        from .async_views import ajax as async_ajax
+        threads = []
+        tree_version = HierarchicalModel.tree_version.__func__
+
+        def recording(cls):
+            threads.append(threading.current_thread())
+            return tree_version(cls)
+        Category.tree_version = classmethod(recording)
+        try:
+            self.run_async(async_ajax(RequestFactory().get("/", {"id": self.root.pk}), model=Category))
+        finally:
+            del Category.tree_version
+        self.assertTrue(threads)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    @override_settings(BITCATEGORY_STATS_BACKEND="bitcategory.instrumentation.MemoryBackend")
+    def test_instrumented(self):
+        from .async_views import ajax as async_ajax
+        self.run_async(async_ajax(RequestFactory().get("/", {"id": self.root.pk}), model=Category))
+        stats = get_backend().stats()
+        self.assertEqual(stats["async_views.ajax"]["calls"], 1)
+        self.assertEqual(stats["async_views.ajax"]["queries"], 1)
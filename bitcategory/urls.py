@@ -17,7 +17,7 @@ pass the namespace into a HierarchicalField associated with the custom model.
 import six
 
 from django.conf.urls import url
-from bitcategory.views import ajax
+from bitcategory.views import ajax, tree
 
 
 def patterns(*args):
@@ -31,4 +31,5 @@ def patterns(*args):
 
 urlpatterns = patterns(
     url(r'^hierarchical_ajax$', ajax, name="hierarchical_ajax"),
+    url(r'^hierarchical_tree$', tree, name="hierarchical_tree"),
 )
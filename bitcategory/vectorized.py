@@ -0,0 +1,112 @@
+#coding: utf-8
+"""Bit arithmetic of hierarchical IDs over whole arrays (requires NumPy).
+
+The functions accept anything convertible to an integer array - a list from
+``values_list("category_id", flat=True)``, a NumPy array or a memory-mapped
+ID column - and never touch the database::
+
+    from bitcategory import vectorized
+
+    ids = numpy.load("order_lines_category.npy", mmap_mode="r")
+    roots = vectorized.ancestors_at(Category, ids, 1)
+    in_sale = vectorized.in_subtrees(Category, ids, [sale, clearance])
+
+The first argument is a `HierarchicalModel` subclass or its `BitLayout`.
+Results follow the semantics of `HierarchicalModel` and `BitLayout` exactly.
+Missing values (NULL foreign keys) have to be filtered out before.
+
+NumPy is an optional dependency: ``pip install django-bit-category[numpy]``.
+"""
+from django.core.exceptions import ImproperlyConfigured
+
+from bitcategory.layout import BitLayout
+from bitcategory.lookups import _nodes, _pk, coalesce_ranges
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _layout(tree):
+    return tree if isinstance(tree, BitLayout) else tree.bit_layout()
+
+
+def _ids(ids):
+    if np is None:
+        raise ImproperlyConfigured("bitcategory.vectorized requires NumPy")
+    ids = np.asarray(ids)
+    if ids.dtype.kind not in "iu":
+        raise ValueError("Hierarchical IDs have to be integers, got {0}".format(ids.dtype))
+    if ids.dtype != np.int64:
+        ids = ids.astype(np.int64)
+    if ids.size and ids.min() <= 0:
+        raise ValueError("Hierarchical ID has to be positive, got {0}".format(ids.min()))
+    return ids
+
+
+def _check_levels(layout, levels):
+    if levels.size and levels.max() > layout.depth:
+        raise ValueError("Malformed hierarchical IDs in the array")
+
+
+def levels(tree, ids):
+    """Level of every ID (depth + 1 for malformed IDs as in `BitLayout.level_of`)."""
+    layout = _layout(tree)
+    ids = _ids(ids)
+    # position of the lowest set bit - exact for powers of two in float64
+    lowest = np.frexp((ids & -ids).astype(np.float64))[1] - 1
+    np.minimum(lowest, layout.id_bits - 1, out=lowest)
+    return np.asarray(layout.bit_levels, dtype=np.int16)[lowest]
+
+
+def ancestors_at(tree, ids, level):
+    """ID of the ancestor at `level` of every ID (the ID itself when it is at `level`).
+
+    Nodes above `level` do not have such an ancestor and get 0.
+    """
+    layout = _layout(tree)
+    if not 1 <= level <= layout.depth:
+        raise ValueError("Level {0} is not in 1..{1}".format(level, layout.depth))
+    ids = _ids(ids)
+    block = layout.masks[level] ^ layout.masks[level - 1]
+    return np.where(ids & block, ids & layout.masks[level], 0)
+
+
+def parent_ids(tree, ids):
+    """Parent ID of every ID (0 for roots)."""
+    layout = _layout(tree)
+    ids = _ids(ids)
+    node_levels = levels(layout, ids)
+    _check_levels(layout, node_levels)
+    return ids & np.asarray(layout.masks, dtype=np.int64)[node_levels - 1]
+
+
+def in_subtrees(tree, ids, nodes):
+    """Boolean mask of IDs lying in a subtree of any of `nodes` (nodes included).
+
+    :param: `nodes` a node or an iterable of nodes (instances or IDs)
+    """
+    layout = _layout(tree)
+    ids = _ids(ids)
+    ranges = coalesce_ranges(layout.bounds(_pk(node)) for node in _nodes(nodes))
+    if not ranges:
+        return np.zeros(ids.shape, dtype=bool)
+    if len(ranges) == 1:
+        gte, lt = ranges[0]
+        return (ids >= gte) & (ids < lt)
+    starts = np.asarray([gte for gte, lt in ranges], dtype=np.int64)
+    ends = np.asarray([lt for gte, lt in ranges], dtype=np.int64)
+    index = np.searchsorted(starts, ids, side="right") - 1
+    return (index >= 0) & (ids < ends[np.maximum(index, 0)])
+
+
+def bucket_by_ancestor(tree, ids, level):
+    """Group IDs by their ancestor at `level`.
+
+    :rvalue: tuple (ancestor_ids, index) where `ancestor_ids` is sorted array of
+             distinct ancestors and ``ancestor_ids[index]`` is the ancestor of
+             every given ID (0 for nodes above `level`). Counts per ancestor are
+             ``numpy.bincount(index)``.
+    """
+    return np.unique(ancestors_at(tree, ids, level), return_inverse=True)
@@ -1,15 +1,45 @@
 #coding: utf-8
 import json
-from django.http import HttpResponse, HttpResponseBadRequest
+import re
+import zlib
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
 
-from bitcategory.models import HierarchicalModel
+from bitcategory.instrumentation import instrumented
+from bitcategory.lookups import coalesce_ranges, ranges_q
+from bitcategory.models import HierarchicalModel, get_cache
 
+re_accepts_gzip = re.compile(r'\bgzip\b')
+AJAX_BAD_REQUEST = "The request has to contain an valid int 'id' and positive int 'depth'"
 
+
+def tree_etag(request, model):
+    '''ETag of any response built from the tree - its current version.'''
+    if not issubclass(model, HierarchicalModel):
+        raise ValueError("Given model has to be a subclass of a HierarchicalModel")
+    return "{0}".format(model.tree_version())
+
+
+def tree_last_modified(request, model):
+    return model.tree_modified()
+
+
+@instrumented("views.ajax")
+@condition(etag_func=tree_etag, last_modified_func=tree_last_modified)
 def ajax(request, model):
     '''
     Should be called via ajax/get request. It expects two parameters in GET
     request: `id` the ID of a calling model and `caller` - an (HTML) ad attribute of
-    the calling widget.
+    the calling widget. Optional `depth` (default 1) says how many levels of
+    descendants to send; it is capped by the levels left below the requested
+    ids. The `id` can be repeated to ask for more parents at once.
+
+    The response carries ETag and Last-Modified of the tree version so a
+    revalidation of unchanged tree is answered by 304 without touching the
+    table. Cache-Control is taken from `BITCATEGORY_AJAX_CACHE_CONTROL` setting
+    (keyword arguments of `patch_cache_control`, {"no_cache": True} by default).
 
     :param: `model` has to be set in your urls.py with default argument - used model as
     `       `url(r"^cats/", 'categories_for', {"model": YourModel})
@@ -17,19 +47,157 @@ def ajax(request, model):
                          {caller: id_of_caller (got from GET['caller'],
                           items: [(key, value), (key, value)]
                           level: <int> // item's level
-                          } or HTTP 400
+                          } or HTTP 400 (also for non-positive `depth`)
+             When more ids or depth > 1 are requested, there is also
+                         children: {parent_id: [(key, value), ...], ...}
+             with children of all the requested items up to `depth` levels.
     '''
-    if not issubclass(model, HierarchicalModel):
-        raise ValueError("Given model has to be a subclass of a HierarchicalModel")
     try:
-        pk = int(request.GET["id"])
-        item = model.objects.get(id=pk)
+        pks, depth, rows = _ajax_query(request, model)
     except (ValueError, KeyError):
-        return HttpResponseBadRequest("The request has to contain an valid int 'id'")
-    except model.DoesNotExist:
+        return HttpResponseBadRequest(AJAX_BAD_REQUEST)
+    return _ajax_response(request, model, pks, depth, rows)
+
+
+def _ajax_query(request, model):
+    '''Return (requested ids, depth, queryset of rows) or raise ValueError.
+
+    `depth` is capped so that the shallowest requested id gets all levels
+    below it; more would only cost work of `_limit_depth`.
+    '''
+    pks = [int(pk) for pk in request.GET.getlist("id")]
+    depth = int(request.GET.get("depth", 1))
+    if not pks or depth < 1:
+        raise ValueError()
+    levels = [model.level_from_id(pk) for pk in pks]
+    depth = max(1, min(depth, model.bit_layout().depth - min(levels)))
+    ranges = coalesce_ranges(model.bounds_for(pk) for pk in pks)
+    deepest = max(levels) + depth
+    rows = model.objects.filter(ranges_q("id", ranges), level__lte=deepest).order_by("id").values_list(
+        "id", "parent_id", "level", "name")
+    return pks, depth, rows
+
+
+def _ajax_response(request, model, pks, depth, rows):
+    '''Build JSON response of `ajax` from fetched `rows`.'''
+    found, children = set(), {}
+    for pk, parent_id, level, name in rows:
+        found.add(pk)
+        children.setdefault(parent_id, []).append((pk, name))
+    if not found.issuperset(pks):
         return HttpResponseBadRequest("Wanted hierarchical model does not exist")
-    items = item.descendants.filter(level=item.level+1).values_list("id", "name")
+
     data = {"caller": request.GET.get("caller", ""),
-            "items": list(items),
-            "level": item.level+1}
-    return HttpResponse(json.dumps(data))
+            "items": children.get(pks[0], []),
+            "level": model.level_from_id(pks[0]) + 1}
+    if len(pks) > 1 or depth > 1:
+        data["children"] = _limit_depth(children, pks, depth)
+    response = HttpResponse(json.dumps(data), content_type="application/json")
+    _patch_cache_control(response)
+    return response
+
+
+def _patch_cache_control(response):
+    patch_cache_control(response, **getattr(settings, "BITCATEGORY_AJAX_CACHE_CONTROL",
+                                            {"no_cache": True}))
+
+
+def _limit_depth(children, pks, depth):
+    '''Return children of `pks` up to `depth` levels below each of them.'''
+    result = {}
+    parents = list(pks)
+    for level in range(depth):
+        next_parents = []
+        for parent_id in parents:
+            if parent_id in children and parent_id not in result:
+                result[parent_id] = children[parent_id]
+                next_parents.extend(pk for pk, name in children[parent_id])
+        parents = next_parents
+    return result
+
+
+def _tree_gzip(request):
+    return (getattr(settings, "BITCATEGORY_TREE_GZIP", True) and
+            bool(re_accepts_gzip.search(request.META.get("HTTP_ACCEPT_ENCODING", ""))))
+
+
+def tree_payload_etag(request, model):
+    '''ETag of the tree payload - it differs for compressed variant.'''
+    return tree_etag(request, model) + ("-gzip" if _tree_gzip(request) else "")
+
+
+def tree_payload_chunks(model, chunk_size=65536):
+    '''
+    Generate JSON of the whole tree in pieces of roughly `chunk_size` characters.
+
+    Nodes go in ID order (i.e. depth-first pre-order) and only the difference
+    to the previous ID is sent. Parents are not sent at all since a parent's
+    ID is the node's ID with the lowest non-zero level block cleared.
+
+        {"id_bits": 32, "level_bits": [5, 5, 5, 5, 5, 5],
+         "nodes": [[id_delta, name], [id_delta, name], ...]}
+    '''
+    layout = model.bit_layout()
+    pieces = ['{{"id_bits": {0}, "level_bits": {1}, "nodes": ['.format(
+        layout.id_bits, json.dumps(layout.widths[1:]))]
+    size = 0
+    previous = 0
+    separator = ""
+    for pk, name in model.objects.order_by("id").values_list("id", "name").iterator():
+        piece = separator + json.dumps([pk - previous, name])
+        pieces.append(piece)
+        size += len(piece)
+        previous, separator = pk, ","
+        if size >= chunk_size:
+            yield "".join(pieces)
+            pieces, size = [], 0
+    pieces.append("]}")
+    yield "".join(pieces)
+
+
+def _stream_and_cache(chunks, key, compress):
+    '''Yield encoded (and compressed) chunks and cache the whole payload at the end.'''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    parts = []
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        if compressor:
+            data = compressor.compress(data)
+        if data:
+            parts.append(data)
+            yield data
+    if compressor:
+        data = compressor.flush()
+        parts.append(data)
+        yield data
+    get_cache().set(key, b"".join(parts))
+
+
+@instrumented("views.tree")
+@condition(etag_func=tree_payload_etag, last_modified_func=tree_last_modified)
+def tree(request, model):
+    '''
+    Send the whole tree in one compact JSON (see `tree_payload_chunks`).
+
+    The payload is streamed while it is generated from the DB for the first
+    time and then it is kept in the cache until the tree version changes.
+    Clients accepting gzip get a pre-compressed payload unless the setting
+    `BITCATEGORY_TREE_GZIP` is False.
+
+    :param: `model` has to be set in your urls.py with default argument
+    '''
+    compress = _tree_gzip(request)
+    key = "{0}:tree:{1}:{2}".format(model._version_key(), model.tree_version(),
+                                    "gzip" if compress else "identity")
+    payload = get_cache().get(key)
+    if payload is not None:
+        response = HttpResponse(payload, content_type="application/json")
+    else:
+        response = StreamingHttpResponse(
+            _stream_and_cache(tree_payload_chunks(model), key, compress),
+            content_type="application/json")
+    if compress:
+        response["Content-Encoding"] = "gzip"
+    patch_vary_headers(response, ("Accept-Encoding", ))
+    _patch_cache_control(response)
+    return response
@@ -1,65 +1,101 @@
 #coding: utf-8
 import copy
 
+import six
+from django.db.models import Q
 from django.utils.encoding import force_text
 from django.forms.widgets import Widget, Select
 from django.template.defaultfilters import mark_safe
 
+from bitcategory.instrumentation import instrumented
+
 
 class HierarchicalSelect(Widget):
 
     class Media:
         js = ('bitcategory/hierarchicalwidget.js', )
 
-    def __init__(self, attrs=None):
+    def __init__(self, attrs=None, choice_cache=None):
         '''
         :param: `url` url where to send the ajax request
+        :param: `choice_cache` optional dict {parent_id: [(id, name), ...]} which
+                can be shared by more widgets (e.g. in a formset) so the choices
+                are loaded only once
         '''
         super(HierarchicalSelect, self).__init__(attrs)
         self.subwidget = Select
         self.model = None
         self.url = None
+        self.choice_cache = choice_cache
+
+    def get_choices(self, parent_ids):
+        '''
+        Return dict {parent_id: [(id, name), ...]} containing children of all
+        `parent_ids` (None stands for roots). Missing ones are loaded by one query.
+        '''
+        cache = self.choice_cache if self.choice_cache is not None else {}
+        missing = [parent_id for parent_id in parent_ids if parent_id not in cache]
+        if missing:
+            query = Q(parent_id__in=[parent_id for parent_id in missing if parent_id is not None])
+            if None in missing:
+                query |= Q(parent__isnull=True)
+            for parent_id in missing:
+                cache[parent_id] = []
+            items = self.model.objects.filter(query).order_by("id").values_list("id", "parent_id", "name")
+            for pk, parent_id, name in items:
+                cache[parent_id].append((pk, name))
+        return cache
+
+    @instrumented("HierarchicalSelect.levels")
+    def levels(self, value):
+        '''
+        Return list of (level, choices, selected_id) for all selects to render.
+
+        If there is a value, there is a select for all its ancestors and one
+        more for its children (if it has any). If no value is given, there is
+        only one select for root level (1). Ancestors are computed from the ID
+        so the only query is the one for choices.
+        '''
+        if value and not isinstance(value, six.integer_types):
+            value = value.pk if hasattr(value, "pk") else int(value)
+        path = self.model.ancestor_ids_for(value) if value else []
+        parents = [None] + path
+        choices = self.get_choices(parents)
+        levels = []
+        for level, parent_id in enumerate(parents, 1):
+            if not choices[parent_id]:
+                break
+            selected = path[level - 1] if level <= len(path) else None
+            levels.append((level, choices[parent_id], selected))
+        return levels
 
     def subwidgets(self, name, value, attrs=None):
         '''
-        If there is a value, this creates widgets for all ancestors. If no value
-        is given, create only one widget for root level (1)
+        Create widgets for all levels (see `levels`)
         '''
-        qs = None
-        if value:
-            qs = list(value.ancestors.order_by("id"))
-            if value.first_child is not None:
-                qs.append(value.first_child)
-        else:
-            qs = self.model.objects.filter(level=1)[0:1]
+        for level, items, selected in self.levels(value):
+            yield self._subwidget(name, level, items, attrs)
 
-        for item in qs:
-            newattrs = copy.copy(attrs)
-            newattrs["id"] = "{0}_{1}".format(newattrs["id"], force_text(item.level))
-            newattrs["name"] = "{0}_{1}".format(name, force_text(item.level))
-            choices = [(None, "-------------"), ]
-            choices.extend(list(item.neighbours.values_list("id", "name")))
-            yield self.subwidget(attrs=newattrs, choices=choices)
+    def _subwidget(self, name, level, items, attrs):
+        newattrs = copy.copy(attrs)
+        newattrs["id"] = "{0}_{1}".format(newattrs["id"], force_text(level))
+        newattrs["name"] = "{0}_{1}".format(name, force_text(level))
+        choices = [(None, "-------------"), ]
+        choices.extend(items)
+        return self.subwidget(attrs=newattrs, choices=choices)
 
     def subrenders(self, name, value, attrs=None):
         '''
-        Grab all created subwidgets and render them using trick with value
+        Render selects of all levels with selected ancestors
         '''
         output = []
-        for i, subwidget in enumerate(self.subwidgets(name, value, attrs)):
-            if value:
-                values = list(value.ancestors.order_by("id").values_list("id", flat=True))
-                values.append(None)  # for one extra select when a value is specified
-            else:
-                values = [None, ]
-            subrender = subwidget.render(name=subwidget.attrs["name"], value=values[i])
-            output.append(subrender)
-        # if there is a value, render one level more
+        for level, items, selected in self.levels(value):
+            subwidget = self._subwidget(name, level, items, attrs)
+            output.append(subwidget.render(name=subwidget.attrs["name"], value=selected))
         return "\n".join(output)
 
+    @instrumented("HierarchicalSelect.render")
     def render(self, name, value=None, attrs=None):
-        if value and isinstance(value, (int)):
-            value = self.model.objects.get(id=value)
         attrs.update({"data:url": self.url, "class": "hierarchical_widget"})
         return mark_safe(self.subrenders(name, value, attrs))
 
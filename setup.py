@@ -20,9 +20,10 @@ setup(
     description="Django category app with bitwise tree-like structure of primary key.",
     long_description=_read("README.rst"),
 
-    packages=['bitcategory', ],
+    packages=['bitcategory', 'bitcategory.management', 'bitcategory.management.commands',
+              'bitcategory.templatetags'],
     package_data={
-        "": ["static/bitcategory/*"],
+        "": ["static/bitcategory/*", "templates/bitcategory/*"],
     },
     include_package_data=True,
 
@@ -33,4 +34,8 @@ setup(
     keywords="django category hierarchy",
 
     install_requires=_read("requirements.txt").split("\n"),
+    extras_require={
+        "numpy": ["numpy"],
+        "async": ["asgiref >= 3.2"],
+    },
 )
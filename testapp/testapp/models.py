@@ -0,0 +1,26 @@
+from django.db import models
+
+from bitcategory import references
+from bitcategory.fields import HierarchicalForeignKey
+from bitcategory.layout import BitLayout
+from bitcategory.managers import PrefetchAncestorsManager
+from bitcategory.pagination import subtree_index
+from bitcategory.models import Category, CategoryBase
+
+
+class Product(models.Model):
+    name = models.CharField(max_length=255)
+    category = HierarchicalForeignKey(Category, related_name="products")
+
+    objects = PrefetchAncestorsManager()
+
+    class Meta:
+        index_together = [subtree_index("category")]
+
+
+references.register(Product, "category")
+
+
+class WideCategory(CategoryBase):
+    """Category with wide levels stored in 64 bit IDs."""
+    LAYOUT = BitLayout([6, 10, 10, 8, 8], id_bits=63)
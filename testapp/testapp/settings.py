@@ -13,6 +13,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',  # Add 'postgresql_psycopg2', 'mysql', 'sqlite3' or 'oracle'.
         'NAME': 'test.db',                      # Or path to database file if using sqlite3.
+        # file (not in-memory) test database so concurrent writers in threads wait for each other
+        'TEST': {'NAME': 'test_testapp.db'},
+        'OPTIONS': {'timeout': 30},
     }
 }
 
@@ -0,0 +1,373 @@
+import json
+
+from django.core.management import CommandError, call_command
+from django.core.paginator import InvalidPage
+from django.db import connection, models
+from django.db.models.deletion import ProtectedError
+from django.test import TestCase
+from six import StringIO
+
+from bitcategory import references
+from bitcategory.defrag import capacity_report, compact
+from bitcategory.models import Category, LevelFullError
+from bitcategory.pagination import SubtreePaginator, subtree_index
+from bitcategory.signals import subtree_deleted
+from testapp.models import Product, WideCategory
+
+
+class MoveTest(TestCase):
+
+    def setUp(self):
+        self.books = Category.objects.create(parent=None, name="books")
+        self.music = Category.objects.create(parent=None, name="music")
+        self.fiction = Category.objects.create(parent=self.books, name="fiction")
+        self.fantasy = Category.objects.create(parent=self.fiction, name="fantasy")
+        self.scifi = Category.objects.create(parent=self.fiction, name="scifi")
+        self.dragons = Category.objects.create(parent=self.fantasy, name="dragons")
+        self.product = Product.objects.create(name="The Hobbit", category=self.dragons)
+
+    def test_move_deeper(self):
+        self.fiction.move_to(self.music)
+        fiction = Category.objects.get(name="fiction")
+        self.assertEqual(fiction.id, self.music.id + fiction.min)
+        self.assertEqual(fiction.parent, self.music)
+        self.assertEqual(fiction.level, 2)
+        dragons = Category.objects.get(name="dragons")
+        self.assertEqual(dragons.level, 4)
+        self.assertEqual(dragons.parent.name, "fantasy")
+        self.assertEqual(dragons.parent.parent, fiction)
+        self.assertEqual(dragons.path, "music/fiction/fantasy/dragons")
+        self.assertEqual([c.name for c in dragons.ancestors.order_by("id")],
+                         ["music", "fiction", "fantasy", "dragons"])
+        self.assertEqual(fiction.descendants.count(), 4)
+        self.assertEqual(self.books.descendants.count(), 1)
+        self.assertEqual(Product.objects.get().category, dragons)
+        self.assertEqual(self.fiction, fiction)
+        self.assertEqual(self.fiction.path, "music/fiction")
+
+    def test_unregistered(self):
+        references.unregister(Product, "category")
+        try:
+            self.assertRaises(ValueError, self.fiction.move_to, self.music)
+            self.assertEqual(Category.objects.get(name="fiction").parent, self.books)
+            self.fiction.move_to(self.music, ignore_unregistered=True)
+        finally:
+            references.register(Product, "category")
+        self.assertEqual(Category.objects.get(name="fiction").parent, self.music)
+        self.assertFalse(Product.objects.filter(category__name="dragons").exists())
+
+    def test_move_to_root(self):
+        self.fantasy.move_to(None)
+        fantasy = Category.objects.get(name="fantasy")
+        self.assertIsNone(fantasy.parent)
+        self.assertEqual(fantasy.level, 1)
+        self.assertEqual(fantasy.id, 3 * fantasy.min)
+        dragons = Category.objects.get(name="dragons")
+        self.assertEqual(dragons.parent, fantasy)
+        self.assertEqual(dragons.level, 2)
+        self.assertEqual(dragons.path, "fantasy/dragons")
+        self.assertTrue(dragons in fantasy)
+        self.assertEqual(Product.objects.filter(category_id__gte=fantasy.gte,
+                                                category_id__lt=fantasy.lt).count(), 1)
+
+    def test_move_root(self):
+        self.books.move_to(self.music)
+        books = Category.objects.get(name="books")
+        self.assertEqual(books.parent, self.music)
+        self.assertEqual(Category.objects.get(name="fiction").parent, books)
+        self.assertEqual(Category.objects.get(name="dragons").path, "music/books/fiction/fantasy/dragons")
+
+    def test_move_under_itself(self):
+        self.assertRaises(ValueError, self.fiction.move_to, self.dragons)
+        self.assertRaises(ValueError, self.fiction.move_to, self.fiction)
+
+
+class LookupTest(TestCase):
+
+    def setUp(self):
+        self.books = Category.objects.create(parent=None, name="books")
+        self.fiction = Category.objects.create(parent=self.books, name="fiction")
+        self.poetry = Category.objects.create(parent=self.books, name="poetry")
+        self.music = Category.objects.create(parent=None, name="music")
+        self.jazz = Category.objects.create(parent=self.music, name="jazz")
+        for category in Category.objects.all():
+            Product.objects.create(name=category.name, category=category)
+
+    def names(self, **kwargs):
+        return sorted(Product.objects.filter(**kwargs).values_list("name", flat=True))
+
+    def test_subtree(self):
+        self.assertEqual(self.names(category__subtree=self.books), ["books", "fiction", "poetry"])
+        self.assertEqual(self.names(category__subtree=self.jazz.id), ["jazz"])
+        self.assertEqual(self.names(category__subtree_in=[self.fiction, self.jazz]), ["fiction", "jazz"])
+        self.assertEqual(self.names(category__subtree_in=[]), [])
+        self.assertEqual(Product.objects.exclude(category__subtree=self.books).count(), 2)
+
+    def test_coalescing(self):
+        query = str(Product.objects.filter(
+            category__subtree_in=[self.books, self.fiction, self.poetry, self.music]).query)
+        self.assertEqual(query.count(" OR "), 0)
+        self.assertEqual(self.names(category__subtree_in=[self.fiction, self.books, self.jazz]),
+                         ["books", "fiction", "jazz", "poetry"])
+
+    def test_ancestor_of(self):
+        self.assertEqual(self.names(category__ancestor_of=self.fiction), ["books", "fiction"])
+        self.assertEqual(self.names(category__ancestor_of=[self.fiction, self.jazz.id]),
+                         ["books", "fiction", "jazz", "music"])
+
+
+class SubtreeCountsTest(TestCase):
+
+    def test_counts(self):
+        books = Category.objects.create(parent=None, name="books")
+        fiction = Category.objects.create(parent=books, name="fiction")
+        fantasy = Category.objects.create(parent=fiction, name="fantasy")
+        music = Category.objects.create(parent=None, name="music")
+        Category.objects.create(parent=None, name="empty")
+        for category, count in ((books, 1), (fiction, 2), (fantasy, 3), (music, 4)):
+            for i in range(count):
+                Product.objects.create(name="p", category=category)
+        Product.objects.create(name="hidden", category=fantasy)
+
+        with self.assertNumQueries(2):
+            nodes = Category.objects.order_by("id").annotate_subtree_counts(
+                Product.objects.exclude(name="hidden"), "category")
+        self.assertEqual([(n.name, n.own_count, n.subtree_count) for n in nodes], [
+            ("books", 1, 6), ("fiction", 2, 5), ("fantasy", 3, 3),
+            ("music", 4, 4), ("empty", 0, 0)])
+        counts = Category.objects.subtree_counts(Product.objects.all(), "category")
+        self.assertEqual(counts[books.id], (1, 7))
+
+
+class PrefetchAncestorsTest(TestCase):
+
+    def setUp(self):
+        books = Category.objects.create(parent=None, name="books")
+        fiction = Category.objects.create(parent=books, name="fiction")
+        music = Category.objects.create(parent=None, name="music")
+        for category in (books, fiction, Category.objects.create(parent=fiction, name="fantasy"),
+                         Category.objects.create(parent=music, name="jazz")):
+            Product.objects.create(name="product", category=category)
+
+    def test_categories(self):
+        with self.assertNumQueries(2):
+            categories = list(Category.objects.filter(level__gte=2).prefetch_ancestors())
+            self.assertEqual([category.full_name() for category in categories],
+                             ["books - fiction", "books - fiction - fantasy", "music - jazz"])
+            self.assertEqual([category.root.name for category in categories],
+                             ["books", "books", "music"])
+            self.assertEqual(categories[1].ancestors.count(), 3)
+
+    def test_through_foreign_key(self):
+        with self.assertNumQueries(2):
+            products = list(Product.objects.order_by("id").prefetch_ancestors("category"))
+            self.assertEqual([product.category.full_name() for product in products],
+                             ["books", "books - fiction", "books - fiction - fantasy",
+                              "music - jazz"])
+        self.assertIs(products[1].category.ancestors[0], products[0].category.ancestors[0])
+
+    def test_invalidation(self):
+        fiction = Category.objects.filter(name="fiction").prefetch_ancestors()[0]
+        fiction.move_to(Category.objects.get(name="music"))
+        self.assertEqual(fiction.full_name(), "music - fiction")
+        fiction = Category.objects.filter(name="fiction").prefetch_ancestors()[0]
+        Category.objects.filter(name="music").update(name="sound")
+        fiction.save()
+        self.assertEqual(fiction.full_name(), "sound - fiction")
+
+
+class DeleteSubtreeTest(TestCase):
+
+    def setUp(self):
+        self.books = Category.objects.create(parent=None, name="books")
+        self.fiction = Category.objects.create(parent=self.books, name="fiction")
+        self.fantasy = Category.objects.create(parent=self.fiction, name="fantasy")
+        self.music = Category.objects.create(parent=None, name="music")
+        Product.objects.create(name="The Hobbit", category=self.fantasy)
+        Product.objects.create(name="Kind of Blue", category=self.music)
+
+    def test_delete_subtree(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append((sender, kwargs["count"]))
+        subtree_deleted.connect(receiver)
+        try:
+            with self.assertNumQueries(4):  # 2 range deletes in a savepoint
+                result = self.fiction.delete_subtree()
+        finally:
+            subtree_deleted.disconnect(receiver)
+        self.assertEqual(result, (3, {"bitcategory.Category": 2, "testapp.Product": 1}))
+        self.assertEqual(received, [(Category, 2)])
+        self.assertIsNone(self.fiction.pk)
+        self.assertEqual(list(Category.objects.order_by("id").values_list("name", flat=True)),
+                         ["books", "music"])
+        self.assertEqual(list(Product.objects.values_list("name", flat=True)), ["Kind of Blue"])
+
+    def test_protect(self):
+        references.register(Product, "category", on_delete=models.PROTECT)
+        try:
+            self.assertRaises(ProtectedError, self.books.delete_subtree)
+        finally:
+            references.register(Product, "category")
+        self.assertEqual(Category.objects.count(), 4)
+
+    def test_queryset(self):
+        result = Category.objects.filter(level=1).delete_subtrees(signal=False)
+        self.assertEqual(result[0], 6)
+        self.assertFalse(Category.objects.exists())
+
+
+class DefragTest(TestCase):
+
+    def setUp(self):
+        names = ["a", "b", "c", "d"]
+        nodes = dict((name, Category.objects.create(parent=None, name=name)) for name in names)
+        for name in names[1:]:
+            for child in range(3):
+                Category.objects.create(parent=nodes[name], name="{0}{1}".format(name, child))
+        Category.objects.create(parent=Category.objects.get(name="c1"), name="c10")
+        Category.objects.get(name="d1").delete_subtree()
+        Category.objects.filter(name__in=["a", "b0"]).delete()
+        Category.objects.filter(name="c0").update(ordering=1)
+        self.product = Product.objects.create(name="p", category=Category.objects.get(name="c10"))
+
+    def test_report(self):
+        report = capacity_report(Category)
+        self.assertEqual([(row["level"], row["nodes"], row["parents"], row["max_used"])
+                          for row in report["levels"]], [(1, 3, 1, 3), (2, 7, 3, 3), (3, 1, 1, 1)])
+        roots = report["parents"][0]
+        self.assertEqual((roots["parent_id"], roots["used"], roots["last_slot"], roots["gaps"]),
+                         (None, 3, 4, 1))
+        self.assertEqual(roots["free"], Category.bit_layout().slot_masks[1] - 3)
+
+    def test_compact(self):
+        ids = list(Category.objects.order_by("id").values_list("id", flat=True))
+        mapping, steps = compact(Category, batch_size=2, dry_run=True)
+        self.assertEqual(steps, [("bitcategory.Category.id", 11), ("testapp.Product.category_id", 1)])
+        self.assertEqual(list(Category.objects.order_by("id").values_list("id", flat=True)), ids)
+
+        with self.assertNumQueries(4 + 1 + 2 * (6 + 1) + (6 + 1)):  # savepoints, load, tree, products
+            mapping, steps = compact(Category, batch_size=2)
+        self.assertEqual(steps, [("bitcategory.Category.id", 11), ("testapp.Product.category_id", 1)])
+        layout = Category.bit_layout()
+        for category in Category.objects.all():
+            self.assertEqual(category.parent_id, layout.parent(category.id))
+        self.assertEqual(list(Category.objects.filter(level=1).order_by("id").values_list(
+            "name", flat=True)), ["b", "c", "d"])
+        c = Category.objects.get(name="c")
+        self.assertEqual(c.slot_index, 2)
+        self.assertEqual([(child.name, child.slot_index) for child in c.children.order_by("id")],
+                         [("c1", 1), ("c2", 2), ("c0", 3)])
+        self.assertEqual(Product.objects.get().category.name, "c10")
+        self.assertEqual(mapping[self.product.category_id], Product.objects.get().category_id)
+        self.assertEqual(compact(Category)[1], [("bitcategory.Category.id", 0),
+                                                ("testapp.Product.category_id", 0)])
+
+    def test_command(self):
+        out = StringIO()
+        call_command("bitcategory_defrag", "bitcategory.Category", "--compact", "--dry-run",
+                     "--json", stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report["compaction"]["moved"], 11)
+        self.assertEqual(len(report["levels"]), 3)
+        out = StringIO()
+        call_command("bitcategory_defrag", "bitcategory.Category", "--threshold", "100",
+                     stdout=out)
+        self.assertIn("Parents with at most 100 free slots", out.getvalue())
+
+    def test_unregistered(self):
+        ids = list(Category.objects.order_by("id").values_list("id", flat=True))
+        references.unregister(Product, "category")
+        try:
+            self.assertRaises(ValueError, compact, Category)
+            self.assertRaises(CommandError, call_command, "bitcategory_defrag",
+                              "bitcategory.Category", "--compact", stdout=StringIO())
+            self.assertEqual(list(Category.objects.order_by("id").values_list("id", flat=True)), ids)
+            err = StringIO()
+            call_command("bitcategory_defrag", "bitcategory.Category", "--compact",
+                         "--ignore-unregistered", stdout=StringIO(), stderr=err)
+            self.assertIn("testapp.Product.category_id is not registered", err.getvalue())
+        finally:
+            references.register(Product, "category")
+        self.assertNotEqual(list(Category.objects.order_by("id").values_list("id", flat=True)), ids)
+
+
+class PaginationTest(TestCase):
+
+    def setUp(self):
+        self.books = Category.objects.create(parent=None, name="books")
+        fiction = Category.objects.create(parent=self.books, name="fiction")
+        music = Category.objects.create(parent=None, name="music")
+        for category in (fiction, self.books, fiction, music, self.books, fiction, fiction):
+            Product.objects.create(name=category.name, category=category)
+        self.expected = list(Product.objects.filter(category__subtree=self.books)
+                             .order_by("category_id", "id"))
+
+    def test_pages(self):
+        paginator = SubtreePaginator(Product.objects.all(), "category", self.books, per_page=2)
+        self.assertEqual(paginator.count, 6)
+        pages, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page = paginator.page(cursor)
+            pages.append(page)
+            cursor = page.next_cursor()
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [2, 2, 2])
+        self.assertEqual([product for page in pages for product in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+        self.assertFalse(pages[-1].has_next())
+        previous = paginator.page(pages[-1].previous_cursor())
+        self.assertEqual(list(previous), list(pages[1]))
+        self.assertTrue(previous.has_next() and previous.has_previous())
+        self.assertRaises(InvalidPage, paginator.page, "garbage")
+
+    def test_index(self):
+        self.assertEqual(subtree_index("category"), ("category", "id"))
+        self.assertIn(("category", "id"), Product._meta.index_together)
+
+
+class LayoutTest(TestCase):
+
+    def test_big_ids(self):
+        self.assertEqual(WideCategory._meta.pk.get_internal_type(), "BigIntegerField")
+        # 32 bits do not fit into a signed integer column either
+        self.assertEqual(Category._meta.pk.get_internal_type(), "BigIntegerField")
+        self.assertEqual(Product._meta.get_field("category").db_type(connection),
+                         Category._meta.pk.db_type(connection))
+        root = WideCategory.objects.create(name="root")
+        self.assertEqual(root.id, 1 << 57)
+        created = WideCategory.objects.bulk_create_tree(["c{0}".format(i) for i in range(400)],
+                                                        parent=root)
+        self.assertEqual(created[-1].id, root.id + (400 << 47))
+        child = WideCategory.objects.create(name="c400", parent=root)
+        self.assertEqual(child.id, root.id + (401 << 47))
+        grandchild = WideCategory.objects.create(name="g", parent=child)
+        self.assertEqual(root.descendants.count(), 403)
+        self.assertEqual(list(grandchild.ancestors.order_by("id")), [root, child, grandchild])
+        self.assertTrue(grandchild in root)
+        self.assertEqual(WideCategory.level_from_id(grandchild.id), 3)
+        self.assertEqual(child.max, 1023 << 47)
+
+    def test_move_between_widths(self):
+        root1 = WideCategory.objects.create(name="root1")
+        root2 = WideCategory.objects.create(name="root2")
+        a = WideCategory.objects.create(name="a", parent=root1)
+        b = WideCategory.objects.create(name="b", parent=a)
+        WideCategory.objects.bulk_create_tree(["x{0}".format(i) for i in range(200)], parent=b)
+        c = WideCategory.objects.create(name="c", parent=root2)
+        # children of `a` in level 3 (10 bits) would not fit into level 4 (8 bits)
+        self.assertRaises(LevelFullError, a.move_to, c)
+        # level 3 (10 bits) with children in level 4 (8 bits) goes to level 2 (10 bits)
+        b.move_to(root2)
+        b = WideCategory.objects.get(name="b")
+        self.assertEqual(b.id, root2.id + (2 << 47))
+        x199 = WideCategory.objects.get(name="x199")
+        self.assertEqual(x199.id, b.id + (200 << 37))
+        self.assertEqual(x199.parent, b)
+        self.assertEqual(x199.level, 3)
+        self.assertEqual(x199.path, "root2/b/x199")
+        self.assertEqual(b.descendants.count(), 201)
+        self.assertEqual(a.descendants.count(), 1)